@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+python %prog [options]
+
+Time of --phylipconsense with collapse_nodes on PHYLIP consense style trees
+(bootstrap counts as the branch lengths) of about --nodes nodes, where
+--low of the nodes are below --support_cutoff. The shapes are a random
+binary tree, a balanced and a caterpillar tree. With --legacy, the former
+node-by-node deletion is timed as well, and checked to give the same tree.
+"""
+
+import os
+import os.path as op
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+sys.path.insert(0, op.join(op.dirname(__file__), ".."))
+from treecut.index import TreeIndex
+from treecut.newick import read_newick
+from treecut.treecut import collapse_nodes, process_phylip_consense
+from suite import split_tree, write_newick
+
+
+SHAPES = dict(random=lambda k, rng: rng.randint(1, k),
+              balanced=lambda k, rng: k // 2,
+              caterpillar=lambda k, rng: k - 1)
+
+
+def collapse_legacy(tree, support_cutoff=0.5):
+    """ Deletes the nodes one by one on child lists, as ete2 does.
+    """
+    support = tree.support.tolist()
+    if min(support) >= support_cutoff:
+        return tree
+
+    children = [tree.children(v).tolist() for v in xrange(len(tree))]
+    up = tree.parent.tolist()
+
+    def delete(v, cascade=True):
+        p = up[v]
+        if p < 0:
+            return
+        for c in children[v]:
+            children[p].append(c)
+            up[c] = p
+        children[p].remove(v)
+        up[v] = -1
+        if cascade and len(children[p]) < 2:
+            delete(p, cascade=False)
+
+    stack = [0]
+    while stack:
+        v = stack.pop()
+        if v >= 0 and children[v]:
+            stack.append(~v)
+            stack.extend(reversed(children[v]))
+            continue
+        v = ~v if v < 0 else v
+        if support[v] < support_cutoff:
+            delete(v)
+
+    return TreeIndex.from_children(children, tree.names, dist=tree.dist,
+                                   support=support)
+
+
+def main(args):
+    p = OptionParser(__doc__)
+    p.add_option("--nodes", type="int", default=100000,
+            help="Number of nodes of the trees [default: %default]")
+    p.add_option("--low", type="float", default=.9,
+            help="Fraction of the nodes below the cutoff [default: %default]")
+    p.add_option("--support_cutoff", type="float", default=.5,
+            help="Cutoff for collapsing [default: %default]")
+    p.add_option("--legacy", action="store_true", default=False,
+            help="Also time the node-by-node deletion [default: %default]")
+    p.add_option("--seed", type="int", default=1,
+            help="Random seed [default: %default]")
+    options, args = p.parse_args(args)
+
+    rng = np.random.RandomState(options.seed)
+    nleaves = (options.nodes + 1) // 2
+    print "\t".join(("shape", "nodes", "collapsed", "parse_s", "collapse_s",
+                     "legacy_s"))
+    for shape, split in sorted(SHAPES.items()):
+        parent = split_tree(nleaves, lambda k: split(k, rng))
+        n = len(parent)
+        # bootstrap counts, --low of them under the cutoff
+        cut = 100 * options.support_cutoff
+        counts = np.where(rng.random_sample(n) < options.low,
+                          rng.uniform(0, cut, n), rng.uniform(cut, 100, n))
+        nchildren = np.bincount(parent[1:], minlength=n)
+        names = ["L%d" % v if not nchildren[v] else "" for v in xrange(n)]
+        fd, treefile = tempfile.mkstemp(suffix=".nwk")
+        os.close(fd)
+        write_newick(TreeIndex(parent, names, dist=counts.round()), treefile)
+
+        start = time.time()
+        tree = read_newick(treefile)
+        parse = time.time() - start
+        os.remove(treefile)
+
+        start = time.time()
+        collapsed = collapse_nodes(tree, options.support_cutoff,
+                                   phylipconsense=True)
+        elapsed = time.time() - start
+
+        legacy = "-"
+        if options.legacy:
+            start = time.time()
+            expected = collapse_legacy(process_phylip_consense(tree),
+                                       options.support_cutoff)
+            legacy = "%.3f" % (time.time() - start)
+            assert list(expected.parent) == list(collapsed.parent)
+            assert expected.names == collapsed.names
+
+        print "%s\t%d\t%d\t%.3f\t%.3f\t%s" % (shape, n, n - len(collapsed),
+                                               parse, elapsed, legacy)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+python %prog [options]
+
+Render time of the dendrogram on random binary trees of growing size with
+continuous values: the layout and drawing calls (Dendrogram), and the saving
+of the image (savefig), with the size of the image file. Use --lod to draw
+with a level-of-detail threshold.
+"""
+
+import os
+import os.path as op
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+sys.path.insert(0, op.join(op.dirname(__file__), ".."))
+from treecut.draw import Dendrogram
+from treecut.tree import ExtTree
+from suite import random_tree
+
+
+def main(args):
+    p = OptionParser(__doc__)
+    p.add_option("--sizes", default="1000,10000,100000",
+            help="Numbers of leaves [default: %default]")
+    p.add_option("--format", default="png",
+            help="Image format [default: %default]")
+    p.add_option("--lod", type="float", default=0,
+            help="Level-of-detail threshold in pixels [default: %default]")
+    p.add_option("--seed", type="int", default=1,
+            help="Random seed [default: %default]")
+    options, args = p.parse_args(args)
+
+    rng = np.random.RandomState(options.seed)
+    print "\t".join(("leaves", "nodes", "stats_s", "layout_s", "savefig_s",
+                     "size_kb"))
+    for n in [int(x) for x in options.sizes.split(",")]:
+        index = random_tree(n, rng)
+        values = dict(zip(index.leaves, rng.normal(size=n)))
+
+        start = time.time()
+        t = ExtTree(index, values, None)
+        stats = time.time() - start
+
+        start = time.time()
+        d = Dendrogram(t, lod=options.lod)
+        layout = time.time() - start
+
+        fd, image_name = tempfile.mkstemp(suffix="." + options.format)
+        os.close(fd)
+        start = time.time()
+        d.savefig(image_name)
+        save = time.time() - start
+        size = op.getsize(image_name) / 1024.
+        os.remove(image_name)
+
+        print "%d\t%d\t%.3f\t%.3f\t%.3f\t%.0f" % (n, len(index), stats,
+                                                  layout, save, size)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
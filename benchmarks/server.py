@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+python %prog [options]
+
+Throughput of the resident server (treecut serve): a random binary tree is
+loaded once, and --clients threads each send --queries queries of random
+continuous values over a Unix socket (or HTTP with --http). Prints the
+queries per second seen by the clients and the latencies kept by the server.
+"""
+
+import os.path as op
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+sys.path.insert(0, op.join(op.dirname(__file__), ".."))
+from treecut.server import Client, Metrics, Service, add_tree, make_server
+from suite import random_tree
+
+
+def main(args):
+    p = OptionParser(__doc__)
+    p.add_option("--sizes", default="1000,10000,100000",
+            help="Numbers of leaves [default: %default]")
+    p.add_option("--queries", type="int", default=50,
+            help="Queries per client [default: %default]")
+    p.add_option("--clients", type="int", default=4,
+            help="Number of client threads [default: %default]")
+    p.add_option("--workers", type="int", default=4,
+            help="Number of server worker processes [default: %default]")
+    p.add_option("--http", action="store_true", default=False,
+            help="Query over localhost HTTP instead of a Unix socket "
+            "[default: %default]")
+    p.add_option("--seed", type="int", default=1,
+            help="Random seed [default: %default]")
+    options, args = p.parse_args(args)
+
+    rng = np.random.RandomState(options.seed)
+    sizes = [int(x) for x in options.sizes.split(",")]
+    queries = {}
+    for n in sizes:
+        index = random_tree(n, rng)
+        add_tree(str(n), index)
+        queries[n] = [dict(zip(index.leaves, rng.normal(size=n).tolist())) \
+                      for i in xrange(4)]
+
+    # the workers are forked with the trees loaded
+    service = Service(workers=options.workers)
+    workdir = tempfile.mkdtemp(prefix="treecut-")
+    if options.http:
+        server = make_server(service, port=0)
+        address = "127.0.0.1:%d" % server.server_address[1]
+    else:
+        address = op.join(workdir, "treecut.sock")
+        server = make_server(service, socket=address)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    print "\t".join(("leaves", "queries", "seconds", "qps", "p50_ms",
+                     "p95_ms"))
+    try:
+        for n in sizes:
+            service.metrics = Metrics()
+
+            def run():
+                client = Client(address)
+                for i in xrange(options.queries):
+                    client.query(str(n), queries[n][i % len(queries[n])])
+                client.close()
+
+            clients = [threading.Thread(target=run) \
+                       for i in xrange(options.clients)]
+            start = time.time()
+            for c in clients:
+                c.start()
+            for c in clients:
+                c.join()
+            elapsed = time.time() - start
+            total = options.queries * options.clients
+            m = service.metrics.report()
+            print "%d\t%d\t%.3f\t%.1f\t%.1f\t%.1f" % (n, total, elapsed,
+                            total / elapsed, m["p50_ms"], m["p95_ms"])
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        service.close()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+python %prog [options]
+
+Wall time and peak memory of a cold `import treecut.treecut`, and of a run
+on the flowering data without image, each in a fresh interpreter (the best
+of --repeats). This is the cost that many short jobs pay again and again.
+"""
+
+import os.path as op
+import subprocess
+import sys
+import tempfile
+from optparse import OptionParser
+
+
+ROOT = op.join(op.dirname(op.abspath(__file__)), "..")
+
+# the peak RSS of this process only, ru_maxrss would count the fork
+MEASURE = "import sys, time; start = time.time(); %s; " \
+          "print time.time() - start, [x.split()[1] for x in " \
+          "open('/proc/self/status') if x.startswith('VmHWM')][0]"
+
+
+def measure(code):
+    out = subprocess.check_output([sys.executable, "-c", MEASURE % code],
+                                  cwd=ROOT, stderr=open("/dev/null", "w"))
+    elapsed, maxrss = out.split()[-2:]
+    return float(elapsed), int(maxrss) / 1024.
+
+
+def main(args):
+    p = OptionParser(__doc__)
+    p.add_option("--repeats", type="int", default=5,
+            help="Number of runs of each case [default: %default]")
+    options, args = p.parse_args(args)
+
+    outfile = op.join(tempfile.mkdtemp(), "flowering.png")
+    run = "from treecut.treecut import main; main(['data/flowering.nwk', " \
+          "'data/flowering.assoc', '%s', '--noimage'])" % outfile
+    print "\t".join(("case", "seconds", "peak_mb"))
+    for case, code in (("import", "import treecut.treecut"),
+                       ("noimage_run", run)):
+        results = [measure(code) for i in xrange(options.repeats)]
+        elapsed = min(x[0] for x in results)
+        maxrss = min(x[1] for x in results)
+        print "%s\t%.3f\t%.1f" % (case, elapsed, maxrss)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+python %prog [options]
+
+Benchmark suite: times every phase of a treecut run on synthetic trees
+(balanced, caterpillar and random coalescent) of growing size, each with
+continuous and discrete values, and on the microarray dataset in data/.
+
+The phases are the Newick parse, collapse_nodes, read_values, the node tests
+of ExtTree, the hi_min/lo_min propagation, get_modules, the output of the
+modules and the rendering. The results are saved as JSON, and --compare
+prints the ratios against an earlier results file.
+"""
+
+import json
+import os
+import os.path as op
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+sys.path.insert(0, op.join(op.dirname(__file__), ".."))
+from treecut.index import TreeIndex
+from treecut.newick import read_newick
+from treecut.stats import fisher_engine
+from treecut.tree import ExtTree
+from treecut.treecut import collapse_nodes, read_values
+
+
+DATADIR = op.join(op.dirname(__file__), "..", "data")
+PHASES = ("parse", "collapse", "read_values", "setup", "stats", "minima",
+          "get_modules", "output", "render")
+
+
+def split_tree(nleaves, split):
+    """ Parent list (in preorder) of the binary tree where a clade of k
+    leaves is split into clades of split(k) and k - split(k) leaves.
+    """
+    parent = []
+    stack = [(nleaves, -1)]
+    while stack:
+        k, p = stack.pop()
+        v = len(parent)
+        parent.append(p)
+        if k > 1:
+            left = split(k)
+            stack.append((k - left, v))
+            stack.append((left, v))
+    return parent
+
+
+def random_tree(nleaves, rng):
+    """ Random binary tree, every clade is split uniformly at random.
+    """
+    parent = split_tree(nleaves, lambda k: rng.randint(1, k))
+    return TreeIndex(parent, [str(v) for v in xrange(len(parent))])
+
+
+def balanced(nleaves, rng):
+    parent = split_tree(nleaves, lambda k: k // 2)
+    return parent, np.ones(len(parent))
+
+
+def caterpillar(nleaves, rng):
+    parent = split_tree(nleaves, lambda k: k - 1)
+    return parent, np.ones(len(parent))
+
+
+def coalescent(nleaves, rng):
+    """ Kingman coalescent: random pairs of lineages merge, after waiting
+    times with rate k(k - 1)/2 when there are k lineages.
+    """
+    children = [[] for i in xrange(2 * nleaves - 1)]
+    height = [0.] * (2 * nleaves - 1)
+    lineages = range(nleaves)
+    now = 0.
+    for v in xrange(nleaves, 2 * nleaves - 1):
+        k = len(lineages)
+        now += rng.exponential(2. / (k * (k - 1)))
+        for j in (k - 1, k - 2):
+            i = rng.randint(0, j + 1)
+            lineages[i], lineages[j] = lineages[j], lineages[i]
+        children[v] = [lineages.pop(), lineages.pop()]
+        height[v] = now
+        lineages.append(v)
+
+    # preorder numbering, from the root (the last merge)
+    root = 2 * nleaves - 2
+    parent, dist = [], []
+    stack = [(root, -1, now)]
+    while stack:
+        u, p, above = stack.pop()
+        parent.append(p)
+        dist.append(above - height[u])
+        v = len(parent) - 1
+        for c in reversed(children[u]):
+            stack.append((c, v, height[u]))
+    return parent, np.array(dist)
+
+
+GENERATORS = dict(balanced=balanced, caterpillar=caterpillar,
+                  coalescent=coalescent)
+
+
+def write_newick(index, filename):
+    """ Newick with the branch lengths, and the supports as the labels of
+    the internal nodes (format 0).
+    """
+    names, dist, support = index.names, index.dist.tolist(), \
+                           index.support.tolist()
+    ptr, idx = index.child_ptr.tolist(), index.child_idx.tolist()
+    out = []
+    stack = [0]
+    while stack:
+        v = stack.pop()
+        if v < 0:
+            v = ~v
+            out.append(")%.3g" % support[v])
+        else:
+            if out and out[-1][-1] != "(":
+                out.append(",")
+            children = idx[ptr[v]:ptr[v + 1]]
+            if children:
+                out.append("(")
+                stack.append(~v)
+                stack.extend(reversed(children))
+                continue
+            out.append(names[v])
+        if v:
+            out.append(":%.6g" % dist[v])
+    out.append(";\n")
+    with open(filename, "w") as fw:
+        fw.write("".join(out))
+
+
+def write_values(index, filename, datatype, rng):
+    """
+    Values for the leaves, with a shifted (continuous) or enriched (discrete)
+    clade of about 5% of the leaves, and 2% of missing values.
+    """
+    n = index.nleaves
+    internal = index.internal_nodes
+    sizes = index.end[internal] - index.start[internal]
+    planted = internal[np.argmin(np.abs(sizes - max(n // 20, 2)))]
+    inside = np.zeros(n, dtype=bool)
+    inside[index.start[planted]:index.end[planted]] = True
+    present = rng.random_sample(n) >= .02
+
+    with open(filename, "w") as fw:
+        print >>fw, "#accession,value"
+        if datatype == "continuous":
+            values = rng.normal(size=n) + 2 * inside
+            for acc, x, has in zip(index.leaves, values, present):
+                if has:
+                    print >>fw, "%s,%.4f" % (acc, x)
+        else:
+            # one or two of 4 categories, the first one enriched in the clade
+            first = np.where(inside & (rng.random_sample(n) < .8), 0,
+                             rng.randint(0, 4, n))
+            second = rng.randint(0, 4, n)
+            two = rng.random_sample(n) < .3
+            for i, acc in enumerate(index.leaves):
+                if not present[i]:
+                    continue
+                categories = sorted(set([first[i], second[i]] if two[i] \
+                                        else [first[i]]))
+                print >>fw, "%s,%s" % (acc, ";".join("c%d" % x \
+                                                    for x in categories))
+
+
+def generate(target, nleaves, workdir, rng):
+    """ Tree and the values files of a synthetic target.
+    """
+    parent, dist = GENERATORS[target](nleaves, rng)
+    support = rng.random_sample(len(parent))
+    nchildren = np.bincount(parent[1:], minlength=len(parent))
+    names = [""] * len(parent)
+    for i, v in enumerate(np.flatnonzero(nchildren == 0).tolist()):
+        names[v] = "L%d" % i
+    index = TreeIndex(parent, names, dist=dist, support=support)
+
+    prefix = op.join(workdir, "%s.%d" % (target, nleaves))
+    treefile = prefix + ".nwk"
+    write_newick(index, treefile)
+    listfiles = {}
+    for datatype in ("continuous", "discrete"):
+        listfiles[datatype] = "%s.%s.assoc" % (prefix, datatype)
+        write_values(index, listfiles[datatype], datatype, rng)
+    return treefile, listfiles
+
+
+def run(treefile, listfile, datatype, workdir, cutoff=.01, lod=4,
+        render=True):
+    """ Run treecut on the files, and return the time of every phase.
+    """
+    timer = Timer()
+    tree = timer("parse", read_newick, treefile)
+    tree = timer("collapse", collapse_nodes, tree, support_cutoff=.5)
+    values = timer("read_values", read_values, listfile, datatype=datatype)
+
+    # the node objects, then the node tests and the propagation on their own,
+    # the tests start without the Fisher's test tables of earlier runs
+    m = len(tree) - tree.nleaves
+    blank = dict(val=np.ones(m), hi_min=np.ones(m), lo_min=np.ones(m),
+                 note=[""] * m)
+    t = timer("setup", ExtTree, tree, values, None, datatype=datatype,
+              results=blank)
+    fisher_engine.cache.clear()
+    timer("stats", t.test_nodes)
+    timer("minima", lambda: (t.lomin(), t.himin()))
+
+    timer("get_modules", t.get_modules, cutoff=cutoff)
+    prefix = op.join(workdir, "out")
+    with open(prefix + ".clusters", "w") as fw:
+        modules = timer("output", t.print_modules, fw, cutoff=cutoff)
+    if render:
+        timer("render", t.render, prefix + ".png", cutoff=cutoff, lod=lod,
+              dpi=80)
+
+    return dict(leaves=tree.nleaves, nodes=len(tree), modules=len(modules),
+                phases=timer.phases)
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.phases = {}
+
+    def __call__(self, phase, func, *args, **kwargs):
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.phases[phase] = time.time() - start
+        return result
+
+
+def compare(results, previous):
+    """ Ratio of the time of every phase to the matching earlier run.
+    """
+    key = lambda r: (r["target"], r["leaves"], r["datatype"])
+    before = dict((key(r), r) for r in previous["runs"])
+    print "\t".join(("target", "leaves", "datatype", "phase", "before",
+                     "after", "ratio"))
+    for r in results["runs"]:
+        b = before.get(key(r))
+        if b is None:
+            continue
+        for phase in PHASES:
+            if phase in r["phases"] and phase in b["phases"]:
+                x, y = b["phases"][phase], r["phases"][phase]
+                print "%s\t%d\t%s\t%s\t%.3f\t%.3f\t%.2f" % (key(r) + (phase,
+                        x, y, y / x if x else float("inf")))
+
+
+def main(args):
+    p = OptionParser(__doc__)
+    p.add_option("--targets",
+            default="balanced,caterpillar,coalescent,microarray",
+            help="Trees to run, the synthetic ones and microarray "
+            "[default: %default]")
+    p.add_option("--sizes", default="1000,10000,100000,1000000",
+            help="Numbers of leaves of the synthetic trees [default: %default]")
+    p.add_option("--datatypes", default="continuous,discrete",
+            help="Values of the synthetic trees [default: %default]")
+    p.add_option("--cutoff", type="float", default=.01,
+            help="Minimum P-value of the modules [default: %default]")
+    p.add_option("--lod", type="float", default=4,
+            help="Level-of-detail threshold of the rendering "
+            "[default: %default]")
+    p.add_option("--norender", action="store_true", default=False,
+            help="Skip the render phase [default: %default]")
+    p.add_option("--json", default="suite.json",
+            help="Write the results to this file [default: %default]")
+    p.add_option("--compare",
+            help="Compare with the results of an earlier run")
+    p.add_option("--workdir",
+            help="Keep the generated files in this directory")
+    p.add_option("--seed", type="int", default=1,
+            help="Random seed [default: %default]")
+    options, args = p.parse_args(args)
+
+    previous = None
+    if options.compare:
+        with open(options.compare) as fp:
+            previous = json.load(fp)
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix="treecut-")
+    if not op.isdir(workdir):
+        os.makedirs(workdir)
+
+    rng = np.random.RandomState(options.seed)
+    sizes = [int(x) for x in options.sizes.split(",")]
+    datatypes = options.datatypes.split(",")
+    results = dict(meta=dict(time=time.strftime("%Y-%m-%d %H:%M:%S"),
+                             python=platform.python_version(),
+                             numpy=np.__version__, machine=platform.node(),
+                             seed=options.seed, cutoff=options.cutoff,
+                             lod=options.lod), runs=[])
+
+    jobs = []
+    for target in options.targets.split(","):
+        if target == "microarray":
+            jobs.append((target, op.join(DATADIR, "microarray.nwk"),
+                         op.join(DATADIR, "microarray.assoc"), "discrete"))
+            continue
+        for n in sizes:
+            treefile, listfiles = generate(target, n, workdir, rng)
+            for datatype in datatypes:
+                jobs.append((target, treefile, listfiles[datatype], datatype))
+
+    print >>sys.stderr, "\t".join(("target", "leaves", "datatype") + PHASES)
+    try:
+        for target, treefile, listfile, datatype in jobs:
+            r = run(treefile, listfile, datatype, workdir,
+                    cutoff=options.cutoff, lod=options.lod,
+                    render=not options.norender)
+            r.update(target=target, datatype=datatype)
+            results["runs"].append(r)
+            print >>sys.stderr, "%s\t%d\t%s\t%s" % (target, r["leaves"],
+                    datatype, "\t".join("%.3f" % r["phases"][x] \
+                    if x in r["phases"] else "-" for x in PHASES))
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+
+    with open(options.json, "w") as fw:
+        json.dump(results, fw, indent=1, sort_keys=True)
+
+    if previous:
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -34,5 +34,6 @@ setup(
     classifiers=classifiers,
     url='http://github.com/tanghaibao/treecut',
     description="Find nodes in hierarchical clustering that are statistically significant",
-    install_requires=required + ["ete2"],
+    install_requires=required,
+    extras_require={"ete": ["ete2"]},
 )
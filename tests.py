@@ -20,13 +20,6 @@ def test_flowering_discrete():
           "flowering_discrete.png", "--discrete"])
 
 
-@pytest.mark.skip(reason="Too slow")
-def test_microarray():
-    """ Microarray experiment
-    """
-    main(["data/microarray.nwk", "data/microarray.assoc", "--discrete"])
-
-
 def test_simple():
     """ Web demo
     """
@@ -38,3 +31,771 @@ def test_ayten():
     """ Test data from Ayten
     """
     main(["data/ayten.nwk", "data/ayten.assoc", "ayten.png"])
+
+
+def test_lod(tmpdir):
+    """ Level-of-detail rendering, with wedges and the value image
+    """
+    for ext in ("png", "pdf"):
+        image = tmpdir.join("flowering." + ext)
+        main(["data/flowering.nwk", "data/flowering.assoc", str(image),
+              "--lod", "4"])
+        assert image.size() > 0
+
+
+def test_startup(tmpdir):
+    """ Cold import and a run without image leave the heavy modules out
+    """
+    import subprocess
+    import sys
+
+    measure = "import sys; %s; print ' '.join(sys.modules)"
+    run = "from treecut.treecut import main; main(['data/flowering.nwk', " \
+          "'data/flowering.assoc', '%s', '--noimage'])" % \
+          tmpdir.join("flowering.png")
+    for code, heavy in (
+            ("import treecut.treecut", ("scipy", "multiprocessing",
+                                        "matplotlib", "ete2")),
+            (run, ("matplotlib", "ete2"))):
+        out = subprocess.check_output([sys.executable, "-c", measure % code],
+                                      stderr=open("/dev/null", "w"))
+        modules = set(x.split(".")[0] for x in out.split())
+        assert not modules.intersection(heavy)
+    assert not tmpdir.join("flowering.png").check()
+
+
+def test_index():
+    """ Leaf intervals of the flat tree index
+    """
+    from treecut.newick import read_newick
+
+    index = read_newick("((((1,2),3),(4,5)),((6,7),8));")
+    assert index.leaves == list("12345678")
+    assert list(index.internal_nodes) == [0, 1, 2, 3, 7, 10, 11]
+    assert index.get_leaf_names(2) == ["1", "2", "3"]
+    assert index.get_leaf_names(7) == ["4", "5"]
+    assert list(index.children(1)) == [2, 7]
+    assert index.parent[7] == 1
+
+
+def test_newick():
+    """ Native Newick reader and node collapsing
+    """
+    from treecut.newick import NewickError, read_newick
+    from treecut.treecut import collapse_nodes, process_phylip_consense
+
+    nw = "((D:0.72,F:0.56)0.3:0.06,(B:0.27,H:0.75)E:0.80);"
+    with pytest.raises(NewickError):
+        read_newick(nw, format=0)
+    t = read_newick(nw, format=1)
+    assert t.names == ["", "0.3", "D", "F", "E", "B", "H"]
+    assert list(t.dist) == [0, .06, .72, .56, .8, .27, .75]
+
+    t = read_newick("((D:72,F:56):6,(B:27,H:75):80);", format=5)
+    t = collapse_nodes(process_phylip_consense(t), support_cutoff=.6)
+    # F and B are deleted, then their parents are left with a single child
+    assert t.leaves == ["D", "H"] and list(t.parent) == [-1, 0, 0]
+    assert list(t.support) == [0, .72, .75]
+
+    t = read_newick("((,),(,));", format=100)
+    assert list(t.parent) == [-1, 0, 1, 1, 0, 4, 4]
+    assert read_newick("A:0.5;").names == ["A"]
+
+
+def test_continuous_all():
+    """ Batched t-test agrees with the per-node t-test
+    """
+    import numpy as np
+    from treecut.stats import stat_test, test_continuous_all
+
+    x = np.array([1, 2, 3, 5, 6, 2, 5, 6, 7, 8, 10, np.nan], dtype=float)
+    starts, ends = np.array([0, 1, 5]), np.array([5, 12, 7])
+    p_values, means = test_continuous_all(x, starts, ends)
+    for s, e, p_value, m in zip(starts, ends, p_values, means):
+        a = [v for v in x[s:e] if not np.isnan(v)]
+        b = [v for v in np.concatenate((x[:s], x[e:])) if not np.isnan(v)]
+        expected, note = stat_test(a, b)
+        if np.isnan(expected):
+            expected = 1
+        assert abs(p_value - expected) < 1e-12
+        assert "%.2g" % m == note
+
+
+def test_datatype():
+    """ The accessions of the former ExtTree signature are not a datatype
+    """
+    from treecut.newick import read_newick
+    from treecut.tree import ExtTree
+    from treecut.treecut import read_values
+
+    index = read_newick("data/flowering.nwk")
+    values = read_values("data/flowering.assoc")
+    with pytest.raises(ValueError):
+        ExtTree(index, values, None, set(index.leaves))
+
+
+def test_continuous_tests():
+    """ Batched Welch and rank-sum tests (with ties) agree with scipy
+    """
+    import numpy as np
+    from treecut.newick import read_newick
+    from treecut.stats import test_continuous, test_continuous_all
+    from treecut.tree import ExtTree
+    from treecut.treecut import read_values
+
+    x = np.array([1, 2, 2, 5, 6, 2, 5, 6, 7, 8, 10, np.nan, 5], dtype=float)
+    starts, ends = np.array([0, 1, 5, 3]), np.array([5, 12, 7, 13])
+    for test in ("welch", "ranksum"):
+        p_values, means = test_continuous_all(x, starts, ends, test=test)
+        for s, e, p_value in zip(starts, ends, p_values):
+            a = [v for v in x[s:e] if not np.isnan(v)]
+            b = [v for v in np.concatenate((x[:s], x[e:])) if not np.isnan(v)]
+            expected = test_continuous(a, b, test=test)[0]
+            assert abs(p_value - expected) < 1e-12
+
+    # edits re-rank the leaves
+    index = read_newick("data/flowering.nwk")
+    values = read_values("data/flowering.assoc")
+    t = ExtTree(index, dict(values), None, test="ranksum")
+    changes = dict((acc, 2 * values[acc]) for acc in index.leaves[:5])
+    t.update_values(changes)
+    values.update(changes)
+    fresh = ExtTree(index, values, None, test="ranksum")
+    assert np.allclose(t.arrays.val, fresh.arrays.val)
+    assert [e.note for e in t.arrays.nodes] == \
+           [e.note for e in fresh.arrays.nodes]
+
+    # the continuous test does not apply to discrete values
+    values = read_values("data/flowering_discrete.assoc", datatype="discrete")
+    fisher = ExtTree(index, values, None, datatype="discrete")
+    t = ExtTree(index, values, None, datatype="discrete", test="ranksum")
+    assert np.array_equal(t.arrays.val, fisher.arrays.val)
+
+
+def test_discrete_all():
+    """ Batched Fisher's exact test agrees with the per-node test
+    """
+    import numpy as np
+    from treecut.stats import category_matrix, stat_test, test_discrete_all
+
+    groups = [["1"], ["1", "2"], ["1"], ["1"], ["0"], None,
+              ["0"], ["0"], ["0", "2"], ["1"], ["0"]]
+    M, categories = category_matrix(groups)
+    starts, ends = np.array([0, 2, 5]), np.array([5, 9, 8])
+    p_values, winners = test_discrete_all(M, starts, ends)
+    for s, e, p_value, w in zip(starts, ends, p_values, winners):
+        a = [x for x in groups[s:e] if x is not None]
+        b = [x for x in groups[:s] + groups[e:] if x is not None]
+        expected, category = stat_test(a, b, datatype="discrete")
+        assert abs(p_value - expected) < 1e-12 * expected
+        assert categories[w] == category
+
+
+def test_interval_counts():
+    """ Category counts of short and long intervals, as the interval matrix
+    """
+    import numpy as np
+    from scipy import sparse
+    from treecut.stats import category_matrix, column_keys, \
+            interval_counts, interval_matrix
+
+    rng = np.random.RandomState(7)
+    groups = [[str(x) for x in rng.randint(4, size=rng.randint(3))] or None
+              for i in range(300)]
+    M, categories = category_matrix(groups)
+    # caterpillar intervals are long, the others short
+    starts = np.r_[np.arange(299), rng.randint(0, 290, 100)]
+    ends = np.r_[np.full(299, 300), starts[299:] + rng.randint(1, 10, 100)]
+    counts = interval_counts(M, starts, ends)
+    assert counts.has_sorted_indices
+    assert (counts.toarray() == (interval_matrix(starts, ends, 300) *
+                                 M).toarray()).all()
+    # the column keys of M are shared by the chunks of the intervals
+    keys = column_keys(M)
+    chunks = [interval_counts(M, starts[i:i + 50], ends[i:i + 50], keys=keys)
+              for i in range(0, len(starts), 50)]
+    assert (sparse.vstack(chunks).toarray() == counts.toarray()).all()
+
+
+def test_fisher_engine():
+    """ Cached Fisher's exact test agrees with scipy
+    """
+    import numpy as np
+    from scipy.stats import fisher_exact
+    from treecut.stats import FisherEngine
+
+    engine = FisherEngine(20, maxsize=3)
+    tables = np.array([[3, 1, 2, 14], [0, 4, 5, 11], [5, 0, 0, 15],
+                       [3, 1, 2, 14], [1, 1, 1, 17]])
+    p_values = engine.pvalues(*tables.T)
+    for table, p_value in zip(tables, p_values):
+        expected = fisher_exact(table.reshape(2, 2), alternative="greater")[1]
+        assert abs(p_value - expected) < 1e-12
+    assert (engine.hits, engine.misses) == (0, 4)
+    assert len(engine.cache) == 3
+    engine.pvalues(*tables.T)
+    assert (engine.hits, engine.misses) == (3, 5)
+
+
+def test_prune():
+    """ Pruned discrete tests find the same modules
+    """
+    from StringIO import StringIO
+    from treecut.newick import read_newick
+    from treecut.tree import ExtTree
+    from treecut.treecut import collapse_nodes, read_values
+
+    index = collapse_nodes(read_newick("data/flowering.nwk"))
+    values = read_values("data/flowering_discrete.assoc", datatype="discrete")
+    for cutoff in (1e-6, .01, .5):
+        outputs = []
+        for prune in (None, cutoff):
+            t = ExtTree(index, values, None, datatype="discrete", prune=prune)
+            fw = StringIO()
+            t.print_modules(fw, cutoff=cutoff)
+            outputs.append(fw.getvalue())
+        assert outputs[0] == outputs[1]
+
+
+def test_jobs():
+    """ Node tests on a process pool give the same P-values
+    """
+    from treecut.newick import read_newick
+    from treecut.tree import ExtTree
+    from treecut.treecut import read_values
+
+    index = read_newick("data/flowering.nwk")
+    for listfile, datatype in (("data/flowering.assoc", "continuous"),
+                    ("data/flowering_discrete.assoc", "discrete")):
+        values = read_values(listfile, datatype=datatype)
+        t1 = ExtTree(index, values, None, datatype=datatype)
+        t2 = ExtTree(index, values, None, datatype=datatype, jobs=2)
+        for e1, e2 in zip(t1.get_all_nodes(), t2.get_all_nodes()):
+            assert (e1.val, e1.note) == (e2.val, e2.note)
+
+
+def test_batch(tmpdir):
+    """ Batch mode gives the same modules as one run per trait
+    """
+    from StringIO import StringIO
+    from treecut.batch import TraitScan
+    from treecut.newick import read_newick
+    from treecut.tree import ExtTree
+    from treecut.treecut import read_traits, read_values
+
+    values = read_values("data/flowering.assoc")
+    listfile = tmpdir.join("traits.assoc")
+    listfile.write("#accession,days,neg\n" + "".join("%s,%s,%s\n" % \
+                   (acc, x, -x if i % 3 else "") \
+                   for i, (acc, x) in enumerate(sorted(values.items()))))
+    traits, rows = read_traits(str(listfile))
+    assert traits == ["days", "neg"]
+
+    index = read_newick("data/flowering.nwk")
+    results = list(TraitScan(index).scan(traits, rows, cutoff=.05))
+    for j, r in enumerate(results):
+        v = dict((acc, x[j]) for acc, x in rows.items() if x[j] == x[j])
+        t = ExtTree(index, v, None)
+        for f, kwargs in (("print_modules", {"cutoff": .05}),
+                          ("print_all_nodes", {})):
+            fw1, fw2 = StringIO(), StringIO()
+            getattr(t, f)(fw1, **kwargs)
+            getattr(r, f)(fw2)
+            assert fw1.getvalue() == fw2.getvalue()
+    assert [e.desc for e in t.get_modules(.05)] == \
+           [results[1].desc(i) for i in results[1].modules]
+
+    outfile = tmpdir.join("batch.png")
+    main(["data/flowering.nwk", str(listfile), str(outfile), "--batch",
+          "--split_traits"])
+    assert tmpdir.join("batch.days.clusters").check()
+    assert tmpdir.join("batch.neg.clusters").check()
+
+
+def test_permutations():
+    """ Empirical P-values and FDR from leaf value shuffles
+    """
+    from StringIO import StringIO
+    from treecut.newick import read_newick
+    from treecut.tree import ExtTree
+    from treecut.treecut import read_values
+
+    index = read_newick("data/flowering.nwk")
+    for listfile, datatype in (("data/flowering.assoc", "continuous"),
+                    ("data/flowering_discrete.assoc", "discrete")):
+        values = read_values(listfile, datatype=datatype)
+        outputs = []
+        for i in range(2):
+            t = ExtTree(index, values, None, datatype=datatype)
+            t.permutation_test(permutations=200, seed=7)
+            fw = StringIO()
+            modules = t.print_modules(fw, cutoff=.01)
+            outputs.append(fw.getvalue())
+        assert outputs[0] == outputs[1]
+        assert all(len(x.split("\t")) == 6 for x in outputs[0].splitlines())
+        # strong modules are never matched by the shuffles
+        assert all(e.empirical == 1 / 201. for e in modules)
+        assert all(0 <= e.fdr <= 1 for e in t.get_all_nodes() if e.fdr)
+
+
+def test_null_discrete_chunks():
+    """ Discrete null P-values in many chunks, as in a single one
+    """
+    import numpy as np
+    from treecut.permute import null_discrete, permuted_leaves
+    from treecut.stats import category_matrix
+
+    rng = np.random.RandomState(3)
+    groups = [[str(x) for x in rng.randint(4, size=rng.randint(3))] or None
+              for i in range(200)]
+    M, categories = category_matrix(groups)
+    starts = np.r_[np.arange(199), rng.randint(0, 190, 50)]
+    ends = np.r_[np.full(199, 200), starts[199:] + rng.randint(1, 10, 50)]
+    idx = permuted_leaves(np.diff(M.indptr) > 0, 5, rng)
+    whole = null_discrete(M, starts, ends, idx)
+    chunked = null_discrete(M, starts, ends, idx, chunksize=50)
+    assert np.allclose(chunked, whole, rtol=1e-12)
+
+
+def test_update_values():
+    """ Incremental re-scoring after value edits, against a fresh tree
+    """
+    import random
+    from StringIO import StringIO
+    from treecut.newick import read_newick
+    from treecut.tree import ExtTree
+    from treecut.treecut import read_values
+
+    def output(t):
+        fw = StringIO()
+        t.print_all_nodes(fw)
+        t.print_modules(fw)
+        return fw.getvalue()
+
+    random.seed(2)
+    index = read_newick("data/flowering.nwk")
+    for listfile, datatype in (("data/flowering.assoc", "continuous"),
+                    ("data/flowering_discrete.assoc", "discrete")):
+        values = read_values(listfile, datatype=datatype)
+        t = ExtTree(index, dict(values), None, datatype=datatype)
+        for i in range(10):
+            changes = {}
+            for acc in random.sample(index.leaves, 3):
+                if random.random() < .2:
+                    changes[acc] = None
+                elif datatype == "continuous":
+                    changes[acc] = random.gauss(80, 50)
+                else:
+                    changes[acc] = [random.choice("01")]
+            t.update_values(changes, refresh=i % 2)
+            t.refresh()
+            fresh = ExtTree(index, dict(t.values), None, datatype=datatype)
+            assert output(t) == output(fresh)
+
+        # an unknown accession changes nothing
+        before = output(t)
+        with pytest.raises(ValueError):
+            t.update_values({index.leaves[0]: None, "missing": None})
+        assert output(t) == before and index.leaves[0] in t.values
+
+
+def test_cache(tmpdir):
+    """ Cached node tests give the same modules, and old entries are evicted
+    """
+    import os
+    import time
+    from StringIO import StringIO
+    from treecut.cache import ResultCache
+    from treecut.newick import read_newick
+    from treecut.tree import ExtTree
+    from treecut.treecut import read_values
+
+    cache = ResultCache(str(tmpdir.join("cache")))
+    keys = [cache.key("data/flowering.nwk", "data/flowering.assoc",
+                      support_cutoff=x) for x in (.5, 0)]
+    assert keys[0] != keys[1] and cache.get(keys[0]) is None
+
+    index = read_newick("data/flowering.nwk")
+    values = read_values("data/flowering.assoc")
+    t = ExtTree(index, values, None)
+    cache.put(keys[0], index, t.results())
+    cached_index, results = cache.get(keys[0])
+    assert cached_index.names == index.names
+    outputs = []
+    for t in (t, ExtTree(cached_index, values, None, results=results)):
+        fw = StringIO()
+        t.print_all_nodes(fw)
+        outputs.append(fw.getvalue())
+    assert outputs[0] == outputs[1]
+
+    # room for one entry only, the least recently used one goes
+    cache.maxsize = os.path.getsize(cache.filename(keys[0]))
+    os.utime(cache.filename(keys[0]), (time.time() - 60,) * 2)
+    cache.put(keys[1], index, results)
+    assert cache.get(keys[0]) is None and cache.get(keys[1])
+
+    outfile = str(tmpdir.join("cached.png"))
+    for i in range(2):
+        main(["data/flowering.nwk", "data/flowering.assoc", outfile,
+              "--cache", "--cache_dir", str(tmpdir.join("cli"))])
+    assert len(tmpdir.join("cli").listdir()) == 1
+
+
+def test_caterpillar():
+    """ A 100k-deep caterpillar tree needs no recursion
+    """
+    import sys
+    from StringIO import StringIO
+    from treecut.index import TreeIndex
+    from treecut.tree import ExtTree
+
+    n = 100000
+    # preorder: every internal node 2i has leaf 2i+1 and next node 2i+2
+    parent = [-1] + [(v - 1) // 2 * 2 for v in xrange(1, 2 * n - 1)]
+    names = [str(v) for v in xrange(2 * n - 1)]
+    index = TreeIndex(parent, names)
+    assert index.nleaves == n
+
+    # high values at the tip of the caterpillar
+    values = dict((x, float(i % 7) + (i >= n - 1000)) \
+                  for i, x in enumerate(index.leaves))
+    limit = sys.getrecursionlimit()
+    t = ExtTree(index, values, None)
+    modules = t.get_modules(cutoff=.05)
+    t.print_all_nodes(StringIO())
+    assert sys.getrecursionlimit() == limit
+    assert len(t.get_all_nodes()) == n - 2
+    assert modules and all(e.desc == "hi" for e in modules)
+
+
+def test_profile(tmpdir):
+    """ Per-stage profile report, and rate-limited progress lines
+    """
+    import json
+    from StringIO import StringIO
+    from treecut.profiling import Progress
+
+    report = tmpdir.join("profile.json")
+    main(["data/flowering.nwk", "data/flowering_discrete.assoc",
+          str(tmpdir.join("flowering.png")), "--discrete", "--noimage",
+          "--profile", str(report)])
+    report = json.load(report.open())
+    stages = [x["name"] for x in report["stages"]]
+    assert stages == ["parse", "collapse", "read_values", "tests", "output"]
+    assert all(x["seconds"] >= 0 and x["peak_rss_kb"] > 0 \
+               for x in report["stages"])
+    assert report["counts"]["nodes_tested"] > 0
+    assert report["counts"]["categories_tested"] > 0
+
+    fw = StringIO()
+    progress = Progress(1000, stream=fw, interval=60)
+    for done in xrange(0, 1001, 10):
+        progress.update(done)
+    progress.close()
+    lines = fw.getvalue().split("\r")[1:]
+    assert len(lines) == 1 and lines[0].startswith("[nodes] 1000/1000")
+
+
+def test_node_table(tmpdir):
+    """ Full-precision TSV and memory-mapped columnar node tables
+    """
+    import numpy as np
+    from StringIO import StringIO
+    from treecut.newick import read_newick
+    from treecut.table import NODE_FIELDS, load_node_table, \
+            save_node_table, write_node_table
+    from treecut.tree import ExtTree
+    from treecut.treecut import read_values
+
+    index = read_newick("data/flowering.nwk")
+    values = read_values("data/flowering.assoc")
+    t = ExtTree(index, values, None)
+    columns = t.node_table()
+
+    fw = StringIO()
+    write_node_table(fw, columns)
+    lines = fw.getvalue().splitlines()
+    assert tuple(lines[0].split("\t")) == NODE_FIELDS
+    assert len(lines) == len(index.internal_nodes)
+    for line, e in zip(lines[1:], t.get_all_nodes()):
+        row = line.split("\t")
+        assert int(row[1]) == e.arrays.scan.parent[e.pos] - 1
+        assert (int(row[2]), int(row[3])) == (index.start[e.id],
+                                              index.end[e.id])
+        assert float(row[7]) == e.val and row[6] == e.note
+
+    # the node ids are those of --printall
+    fw = StringIO()
+    t.print_all_nodes(fw)
+    printall = [x.split("\t") for x in fw.getvalue().splitlines()]
+    assert [int(x[0]) for x in printall] == list(columns["node_id"])
+    assert [x[4] for x in printall] == \
+           ["%.1g" % x for x in columns["pvalue"]]
+
+    npz = str(tmpdir.join("nodes.npz"))
+    save_node_table(npz, columns)
+    table = load_node_table(npz)
+    assert isinstance(table["pvalue"], np.memmap)
+    for x in NODE_FIELDS:
+        assert list(table[x]) == list(columns[x])
+
+
+def test_api(tmpdir):
+    """ In-memory runs give the modules of main, without writing files
+    """
+    import numpy as np
+    from treecut.api import cut
+    from treecut.treecut import read_values
+
+    nw = open("data/flowering.nwk").read()
+    values = read_values("data/flowering.assoc")
+    r = cut(nw, values, cutoff=.05)
+    assert not tmpdir.listdir()
+    assert r.nodes.dtype.names[:4] == ("node_id", "parent_id", "leaf_start",
+                                       "leaf_end")
+    assert list(r.nodes["pvalue"]) == list(r.tree.arrays.val[1:])
+    assert list(r.nodes["pvalue"][r.modules["node_id"]]) == \
+           list(r.modules["pvalue"])
+
+    clusters = tmpdir.join("flowering.clusters")
+    main(["data/flowering.nwk", "data/flowering.assoc", str(clusters),
+          "--noimage", "--cutoff", ".05"])
+    expected = [x.split("\t")[:2] for x in clusters.readlines()]
+    assert [[",".join(sorted(r.leaves[m["leaf_start"]:m["leaf_end"]])),
+             m["desc"]] for m in r.modules] == expected
+
+    # the same tree as parent ids, and the values in leaf order
+    index = r.tree.index
+    x = np.array([values.get(acc, np.nan) for acc in index.leaves])
+    r2 = cut(list(index.parent), x, names=index.names, support_cutoff=0)
+    assert np.array_equal(r2.modules, r.modules)
+
+
+def test_server(tmpdir):
+    """ Resident server answers queries over a Unix socket and HTTP
+    """
+    import threading
+    from treecut.server import Client, Service, load_tree, make_server
+    from treecut.tree import ExtTree
+    from treecut.treecut import collapse_nodes, read_tree, read_values
+
+    load_tree("flowering", "data/flowering.nwk")
+    values = read_values("data/flowering.assoc")
+    t = ExtTree(collapse_nodes(read_tree("data/flowering.nwk")), values, None)
+    expected = [(sorted(e.get_leaf_names()), e.desc) for e in t.get_modules()]
+
+    service = Service(workers=1)
+    try:
+        for kwargs in (dict(socket=str(tmpdir.join("treecut.sock"))),
+                       dict(port=0)):
+            server = make_server(service, **kwargs)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            address = kwargs.get("socket") or "127.0.0.1:%d" % \
+                      server.server_address[1]
+            client = Client(address)
+            try:
+                for i in range(2):
+                    r = client.query("flowering", values)
+                    assert [(sorted(m["leaves"]), m["desc"]) \
+                            for m in r["modules"]] == expected
+                assert "error" in client.query("nothere", values)
+            finally:
+                client.close()
+                server.shutdown()
+                server.server_close()
+                thread.join()
+        metrics = service.metrics.report()
+        assert metrics["requests"] == 6 and metrics["errors"] == 2
+    finally:
+        service.close()
+
+
+def test_server_error(monkeypatch):
+    """ Unexpected failures of a query are answered and counted
+    """
+    import json
+    import treecut.server
+
+    def answer(request):
+        return 1 / 0
+
+    monkeypatch.setattr(treecut.server, "answer", answer)
+    service = treecut.server.Service(workers=0)
+    status, body = service.handle(json.dumps(dict(tree="flowering")))
+    assert status == 500
+    assert json.loads(body)["error"].startswith("ZeroDivisionError")
+    assert service.metrics.report()["errors"] == 1
+
+
+def test_collapse_phylipconsense():
+    """ Phylip CONSENSE supports leave the parsed tree unchanged
+    """
+    import numpy as np
+    from treecut.newick import read_newick
+    from treecut.treecut import collapse_nodes
+
+    tree = read_newick("(((A:100,B:100):72,C:100):30,(D:100,E:100):100);")
+    dist, support = tree.dist.copy(), tree.support.copy()
+    first = collapse_nodes(tree, phylipconsense=True)
+    again = collapse_nodes(tree, phylipconsense=True)
+    assert np.array_equal(tree.dist, dist)
+    assert np.array_equal(tree.support, support)
+    # the children of the 30% clade are appended to the root, as in ete2
+    assert list(first.parent) == list(again.parent) == [-1, 0, 1, 1, 0, 4, 4, 0]
+    assert first.leaves == again.leaves == list("DEABC")
+
+
+def test_collapse_caterpillar():
+    """ Collapsing a 100k-node caterpillar to a star is a single pass
+    """
+    import time
+    import numpy as np
+    from treecut.index import TreeIndex
+    from treecut.treecut import collapse_nodes
+
+    n = 50000
+    parent = [-1] + [(v - 1) // 2 * 2 for v in xrange(1, 2 * n - 1)]
+    names = [str(v) for v in xrange(2 * n - 1)]
+    # bootstrap counts as branch lengths, low on all the internal nodes
+    index = TreeIndex(parent, names)
+    index.dist = np.where(index.is_leaf, 90., 10.)
+
+    start = time.time()
+    t = collapse_nodes(index, support_cutoff=.5, phylipconsense=True)
+    assert time.time() - start < 5
+    assert list(t.parent) == [-1] + [0] * n
+    assert sorted(t.leaves) == sorted(index.leaves)
+    assert list(t.dist) == [1] * (n + 1)
+
+
+def test_support_sweep(tmpdir):
+    """ A sweep of support cutoffs gives the modules of one run per cutoff
+    """
+    import os
+    from StringIO import StringIO
+    from treecut.newick import read_newick
+    from treecut.tree import ExtTree
+    from treecut.treecut import collapse_nodes, read_values, sweep_support
+
+    tree = read_newick("data/flowering.nwk")
+    for listfile, datatype in (("data/flowering.assoc", "continuous"),
+                    ("data/flowering_discrete.assoc", "discrete")):
+        values = read_values(listfile, datatype=datatype)
+        cutoffs = (.9, 0, .5, .7)
+        swept = list(sweep_support(tree, values, cutoffs, datatype=datatype))
+        assert [x for x, t in swept] == sorted(cutoffs)
+        for cutoff, t in swept:
+            fresh = ExtTree(collapse_nodes(tree, support_cutoff=cutoff),
+                            values, None, datatype=datatype)
+            outputs = []
+            for x in (t, fresh):
+                fw = StringIO()
+                x.print_all_nodes(fw)
+                x.print_modules(fw)
+                outputs.append(fw.getvalue())
+            assert outputs[0] == outputs[1]
+
+    outfile = tmpdir.join("sweep.png")
+    main(["data/flowering.nwk", "data/flowering.assoc", str(outfile),
+          "--noimage", "--support_cutoff", "0.3,0.6"])
+    assert tmpdir.join("sweep.support0.3.clusters").check()
+    assert tmpdir.join("sweep.support0.6.clusters").check()
+
+    # without an image name, the images are outfile.support*.png
+    treefile, listfile = (os.path.abspath(x) for x in ("data/flowering.nwk",
+                                                   "data/flowering.assoc"))
+    with tmpdir.as_cwd():
+        main([treefile, listfile, "--support_cutoff", "0.3,0.6"])
+    for cutoff in ("0.3", "0.6"):
+        assert tmpdir.join("outfile.support%s.clusters" % cutoff).check()
+        assert tmpdir.join("outfile.support%s.png" % cutoff).check()
+
+
+def test_module_path(tmpdir):
+    """ The module path gives the modules of the level sweep at any cutoff
+    """
+    import numpy as np
+    from treecut.newick import read_newick
+    from treecut.tree import ExtTree
+    from treecut.treecut import read_values
+
+    index = read_newick("data/flowering.nwk")
+    for listfile, datatype in (("data/flowering.assoc", "continuous"),
+                    ("data/flowering_discrete.assoc", "discrete")):
+        values = read_values(listfile, datatype=datatype)
+        t = ExtTree(index, values, None, datatype=datatype)
+        arrays = t.arrays
+        path = t.module_path()
+        cutoffs = np.r_[0, np.unique(arrays.val), .05, 1.]
+        for cutoff in cutoffs:
+            # modules: below all the cutoffs and no module above
+            hit = arrays.val < np.minimum(np.minimum(arrays.hi_min,
+                                                     arrays.lo_min), cutoff)
+            hit[0] = False
+            below = np.zeros_like(hit)
+            for level in arrays.scan.levels:
+                p = arrays.scan.parent[level]
+                below[level] = below[p] | hit[p]
+            expected = np.flatnonzero(hit & ~below)
+            assert list(path.modules(cutoff)) == list(expected)
+            assert [e.pos for e in t.get_modules(cutoff)] == list(expected)
+        assert list(path.count(cutoffs)) == \
+               [len(path.modules(x)) for x in cutoffs]
+
+    cutoff_table = tmpdir.join("cutoffs.tsv")
+    main(["data/flowering.nwk", "data/flowering.assoc", "--noimage",
+          "--cutoff_table", str(cutoff_table)])
+    lines = cutoff_table.readlines()
+    assert lines[0].split() == ExtTree.cutoff_fields
+    assert [int(x.split("\t")[1]) for x in lines[1:]] == \
+           range(1, len(lines))
+
+
+def test_bootstrap(tmpdir):
+    """ Module recovery over replicate trees agrees with the leaf name sets
+    """
+    import random
+    from treecut.bootstrap import module_stability
+    from treecut.newick import iter_newick, read_newick
+    from treecut.tree import ExtTree
+    from treecut.treecut import collapse_nodes, read_values
+
+    def newick(index, v=0, swap={}):
+        children = list(index.children(v))
+        if not children:
+            return swap.get(index.names[v], index.names[v])
+        random.shuffle(children)
+        return "(%s)" % ",".join(newick(index, c, swap) for c in children)
+
+    random.seed(3)
+    index = read_newick("data/flowering.nwk")
+    values = read_values("data/flowering.assoc")
+    t = ExtTree(collapse_nodes(index), values, None)
+    modules = t.get_modules(cutoff=.01)
+    inside = modules[0].get_leaf_names()[0]
+    replicates = tmpdir.join("replicates.nwk")
+    swaps = [{}, {inside: index.leaves[-1], index.leaves[-1]: inside}, {}]
+    replicates.write("\n".join(newick(index, swap=x) + ";" for x in swaps))
+
+    trees = list(iter_newick(str(replicates)))
+    modules, clades, recovered, ntrees = module_stability(t, trees,
+                                                          cutoff=.01)
+    assert ntrees == 3
+    expected = [0] * len(modules)
+    for tree in trees:
+        found = set(frozenset(e.get_leaf_names()) for e in \
+                    ExtTree(tree, values, None).get_modules(cutoff=.01))
+        for i, e in enumerate(modules):
+            expected[i] += frozenset(e.get_leaf_names()) in found
+    assert list(recovered) == expected
+    assert expected[0] == 2
+    assert all(c >= r for c, r in zip(clades, recovered))
+
+    main(["data/flowering.nwk", "data/flowering.assoc",
+          str(tmpdir.join("bs.png")), "--noimage", "--cutoff", ".01",
+          "--bootstrap", str(replicates), "--jobs", "2"])
+    lines = tmpdir.join("bs.stability").readlines()
+    assert len(lines) == len(modules)
+    assert [float(x.split("\t")[-1]) for x in lines] == \
+           [round(x / 3., 3) for x in expected]
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+In-memory entry point: cut() takes the tree and the values as Python objects
+and returns the node statistics and the modules as NumPy structured arrays,
+without reading or writing any file unless asked to, and without printing.
+
+>>> r = cut("((A,B)1:1,(C,D)1:1);", {"A": 1, "B": 1.1, "C": 5, "D": 5.2},
+...         cutoff=1)
+>>> r.leaves
+['A', 'B', 'C', 'D']
+>>> list(r.nodes["ntaxa_a"]), list(r.modules["desc"])
+([4, 2, 2], ['lo', 'hi'])
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from .index import TreeIndex
+from .newick import read_newick
+from .table import table_fields
+from .tree import ExtTree
+from .treecut import collapse_nodes
+
+
+MODULE_FIELDS = ("node_id", "leaf_start", "leaf_end", "desc", "note",
+                 "pvalue")
+
+CutResult = namedtuple("CutResult", "nodes modules leaves tree")
+
+
+def as_tree_index(tree, names=None, treeformat=0):
+    """
+    TreeIndex of `tree`, which is either a TreeIndex, a Newick string (or
+    file name), an ete2 tree, a list of parent ids (nodes in preorder) or a
+    list of child id lists (the root is node 0). The last two need the
+    `names` of all the nodes.
+    """
+    if isinstance(tree, TreeIndex):
+        return tree
+    if isinstance(tree, basestring):
+        return read_newick(tree, format=treeformat)
+    if hasattr(tree, "traverse"):
+        return TreeIndex.from_ete(tree)
+    if names is None:
+        raise ValueError("names are needed for a tree given as arrays")
+    if len(tree) and not np.isscalar(tree[0]):
+        return TreeIndex.from_children([list(x) for x in tree], names)
+    return TreeIndex(tree, names)
+
+
+def as_values(values, leaves, datatype):
+    """
+    {accession: value} from a dict, a pair of accession and value arrays, or
+    an array of values in leaf order where NaN (continuous) or None
+    (discrete) are missing.
+    """
+    if isinstance(values, dict):
+        return values
+    if isinstance(values, tuple) and len(values) == 2:
+        accs, x = values
+    else:
+        accs, x = leaves, values
+        if len(x) != len(leaves):
+            raise ValueError("%d values for %d leaves" % (len(x), len(leaves)))
+    if datatype == "continuous":
+        return dict((acc, v) for acc, v in \
+                    zip(accs, np.asarray(x, dtype=float).tolist()) if v == v)
+    return dict((acc, v) for acc, v in zip(accs, x) if v is not None)
+
+
+def infer_datatype(values):
+    sample = next(iter(values.values() if isinstance(values, dict) else \
+                       values[1] if isinstance(values, tuple) else values),
+                  None)
+    if isinstance(sample, (basestring, list, tuple, set)):
+        return "discrete"
+    return "continuous"
+
+
+def to_records(columns, fields):
+    """ Structured array from the columns of a table, where the notes and
+    descriptions are lists of strings.
+    """
+    arrays = []
+    for x in fields:
+        a = columns[x]
+        arrays.append(np.array(list(a), dtype="S") if x in ("note", "desc") \
+                      else np.asarray(a))
+    n = len(arrays[0]) if arrays else 0
+    dtype = [(x, a.dtype) for x, a in zip(fields, arrays)]
+    records = np.empty(n, dtype=dtype)
+    for x, a in zip(fields, arrays):
+        records[x] = a
+    return records
+
+
+def cut(tree, values, datatype=None, names=None, cutoff=.05,
+        support_cutoff=.5, treeformat=0, prune=False, jobs=1, permutations=0,
+        seed=None, clusters=None, image=None, lod=0, test="ttest"):
+    """
+    Run treecut in memory. `tree` is any of the inputs of as_tree_index, and
+    `values` any of the inputs of as_values; the datatype is inferred from
+    the values when not given ("discrete" for lists of categories). `test` is
+    the test of continuous values, one of stats.CONTINUOUS_TESTS.
+
+    Returns a CutResult: `nodes` holds one record per internal node below
+    the root (fields and node ids as in treecut.table), `modules` one record
+    per module, whose    leaves are leaves[leaf_start:leaf_end], and `tree` is the ExtTree. The
+    modules are written to the `clusters` file and drawn into `image` only
+    when these are given.
+    """
+    if datatype is None:
+        datatype = infer_datatype(values)
+    index = as_tree_index(tree, names=names, treeformat=treeformat)
+    index = collapse_nodes(index, support_cutoff=support_cutoff)
+    values = as_values(values, index.leaves, datatype)
+
+    t = ExtTree(index, values, None, datatype=datatype,
+                prune=cutoff if prune else None, jobs=jobs, test=test)
+    if permutations:
+        t.permutation_test(permutations=permutations, seed=seed)
+
+    columns = t.node_table()
+    nodes = to_records(columns, table_fields(columns))
+
+    modules = t.get_modules(cutoff=cutoff)
+    ids = np.array([e.pos - 1 for e in modules], dtype=np.int64)
+    starts, ends = t.intervals(modules)
+    modules = to_records(dict(node_id=ids, leaf_start=starts, leaf_end=ends,
+                              desc=[e.desc for e in modules],
+                              note=[e.note for e in modules],
+                              pvalue=np.array([e.val for e in modules])),
+                         MODULE_FIELDS)
+
+    if clusters:
+        with open(clusters, "w") as fw:
+            t.print_modules(fw, cutoff=cutoff)
+    if image:
+        t.render(image, cutoff=cutoff, lod=lod, dpi=80)
+    return CutResult(nodes, modules, index.leaves, t)
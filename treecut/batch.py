@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Batch mode: scan many traits (value columns) against the same tree.
+
+The tree is parsed and indexed once. Node statistics of a block of traits are
+node x trait matrices, and the hi_min/lo_min propagation and the module search
+of ExtTree become sweeps over the depth levels of the tree, where every step
+is a row operation covering all the traits of the block at once.
+"""
+
+import numpy as np
+
+from stats import category_matrix, interval_sums, test_continuous_all, \
+            test_discrete_all
+from parallel import test_nodes_parallel
+from table import node_columns
+
+
+class TraitResult(object):
+    """
+    P-values and modules of a single trait, over the internal nodes of the
+    tree (in preorder, the root first). Prints the same lines as ExtTree.
+    """
+
+    def __init__(self, index, trait, datatype, na, nb, val, hi_min, lo_min,
+                 modules, notes, desc, scan=None):
+        self.index = index
+        self.scan = scan
+        self.trait = trait
+        self.datatype = datatype
+        self.na, self.nb, self.val = na, nb, val
+        self.hi_min, self.lo_min = hi_min, lo_min
+        self.modules = modules
+        self.notes = notes
+        self.desc = desc
+
+    def note(self, i):
+        return self.notes(i) if self.na[i] and self.nb[i] else ""
+
+    def print_all_nodes(self, filehandle):
+        for i in xrange(1, len(self.val)):
+            print >>filehandle, "%d\t%d\t%d\t%s\t%.1g\t%.1g\t%.1g" % (i - 1,
+                    self.na[i], self.nb[i], self.note(i), self.val[i],
+                    self.hi_min[i], self.lo_min[i])
+
+    def node_table(self):
+        """ Columns of the node table (see treecut.table).
+        """
+        scan = self.scan or TraitScan(self.index)
+        return node_columns(scan, self.na, self.nb,
+                            [self.note(i) for i in xrange(len(self.val))],
+                            self.val, self.hi_min, self.lo_min)
+
+    def print_modules(self, filehandle):
+        internal = self.index.internal_nodes
+        for i in self.modules:
+            names = self.index.get_leaf_names(internal[i])
+            print >>filehandle, "%s\t%s\t%s\t%.1g" % (",".join(sorted(names)),
+                    self.desc(i), self.note(i), self.val[i])
+
+
+class TraitScan(object):
+    """
+    Shared preprocessing of the tree for scan(): the internal nodes, their
+    leaf intervals, and their grouping into depth levels.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        internal = index.internal_nodes
+        pos = np.zeros(len(index), dtype=np.int64)
+        pos[internal] = np.arange(len(internal))
+        self.parent = pos[index.parent[internal]]
+        self.parent[0] = -1
+        self.starts = index.start[internal]
+        self.ends = index.end[internal]
+
+        depth = [0] * len(internal)
+        plist = self.parent.tolist()
+        for i in xrange(1, len(internal)):
+            depth[i] = depth[plist[i]] + 1
+        # nodes of a level stay in preorder, so siblings are contiguous
+        order = np.argsort(depth, kind="mergesort")
+        cuts = np.flatnonzero(np.diff(np.take(depth, order))) + 1
+        self.levels = np.split(order, cuts)[1:]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def minima(self, val):
+        """
+        hi_min and lo_min of all the nodes, for a node x trait matrix of
+        P-values: the smallest P-value among the ancestors and among the
+        descendants, capped at 1.
+        """
+        return self.hi_minima(val), self.lo_minima(val)
+
+    def hi_minima(self, val):
+        hi_min = np.ones_like(val)
+        for level in self.levels:
+            p = self.parent[level]
+            hi_min[level] = np.minimum(hi_min[p], val[p])
+        return hi_min
+
+    def lo_minima(self, val):
+        lo_min = np.ones_like(val)
+        for level in reversed(self.levels):
+            p = self.parent[level]
+            first = np.flatnonzero(np.r_[True, p[1:] != p[:-1]])
+            m = np.minimum.reduceat(np.minimum(lo_min[level], val[level]),
+                                    first, axis=0)
+            p = p[first]
+            lo_min[p] = np.minimum(lo_min[p], m)
+        return lo_min
+
+    def modules(self, val, hi_min, lo_min, cutoff):
+        """
+        Module mask: the nodes with P-value below all of hi_min, lo_min and
+        cutoff. These are never nested (see treecut.modules), so there is no
+        module above them to check.
+        """
+        hit = val < np.minimum(np.minimum(hi_min, lo_min), cutoff)
+        hit[0] = False
+        return hit
+
+    def test_block(self, traits, columns, datatype, prune=None, jobs=1,
+                   test="ttest"):
+        """ Node x trait matrices of P-values, group sizes and notes.
+        """
+        m, ntraits = len(self), len(traits)
+        starts, ends = self.starts, self.ends
+        if datatype == "continuous":
+            x = np.array(columns, dtype=float)
+            has = ~np.isnan(x)
+            p_values, ma = test_continuous_all(x, starts, ends, test=test)
+            na = interval_sums(has, starts, ends)
+            nb = has.sum(axis=0) - na
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mb = (np.nansum(x, axis=0) - na * ma) / nb
+            notes = [lambda i, j=j: "%.2g" % ma[i, j] for j in xrange(ntraits)]
+            descs = [lambda i, j=j: "lo" if ma[i, j] < mb[i, j] else "hi" \
+                     for j in xrange(ntraits)]
+            return na, nb, p_values, notes, descs
+
+        na = np.zeros((m, ntraits))
+        nb = np.zeros((m, ntraits))
+        p_values = np.ones((m, ntraits))
+        notes = []
+        for j in xrange(ntraits):
+            groups = [x[j] for x in columns]
+            has = np.array([x is not None for x in groups])
+            na[:, j] = interval_sums(has, starts, ends)
+            nb[:, j] = has.sum() - na[:, j]
+            tested = np.flatnonzero((na[:, j] > 0) & (nb[:, j] > 0))
+            M, categories = category_matrix(groups)
+            if jobs > 1:
+                p, winners = test_nodes_parallel(M, starts[tested],
+                                    ends[tested], jobs, cutoff=prune)
+            else:
+                p, winners = test_discrete_all(M, starts[tested], ends[tested],
+                                               cutoff=prune)
+            p_values[tested, j] = p
+            code = np.zeros(m, dtype=np.int64)
+            code[tested] = winners
+            notes.append(lambda i, code=code, categories=categories: \
+                         categories[code[i]] if code[i] >= 0 else "")
+        descs = [lambda i: "enriched"] * ntraits
+        return na, nb, p_values, notes, descs
+
+    def scan(self, traits, values, datatype="continuous", cutoff=.05,
+             prune=None, jobs=1, blocksize=None, test="ttest"):
+        """
+        Test all the traits, and yield their TraitResult in order. `values`
+        maps the accessions to the list of their values for every trait, NaN
+        (continuous) or None (discrete) when missing, and `test` is the test of
+        continuous values (see stats.CONTINUOUS_TESTS). Traits are processed in
+        blocks of `blocksize`, by default enough to fill about 4M nodes x
+        traits.
+        """
+        index = self.index
+        ntraits = len(traits)
+        if blocksize is None:
+            blocksize = max(1, (1 << 22) // max(len(self), 1))
+        missing = [np.nan if datatype == "continuous" else None] * ntraits
+        rows = [values.get(acc, missing) for acc in index.leaves]
+
+        for lo in xrange(0, ntraits, blocksize):
+            hi = min(lo + blocksize, ntraits)
+            columns = [x[lo:hi] for x in rows]
+            na, nb, val, notes, descs = self.test_block(traits[lo:hi],
+                                columns, datatype, prune=prune, jobs=jobs,
+                                test=test)
+            untested = (na == 0) | (nb == 0)
+            val[untested] = 1
+            hi_min, lo_min = self.minima(val)
+            modules = self.modules(val, hi_min, lo_min, cutoff)
+            for j in xrange(hi - lo):
+                yield TraitResult(index, traits[lo + j], datatype,
+                        na[:, j].astype(int), nb[:, j].astype(int),
+                        val[:, j], hi_min[:, j], lo_min[:, j],
+                        np.flatnonzero(modules[:, j]), notes[j], descs[j],
+                        scan=self)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Stability of the modules over an ensemble of trees, such as the bootstrap
+replicates that PHYLIP CONSENSE summarizes.
+
+The values are read once and the leaf names of all the trees are interned
+into integer ids, so every tree only maps its leaves to rows of the same leaf
+data. The trees are scored on a pool of processes. A leaf set is compared
+across trees by its signature: the XOR of the hashes of its leaf ids, which
+is a prefix XOR over the leaf order for every leaf interval, so that the
+identical leaf sets of two trees have the same signature whatever the leaf
+order, without sorting names.
+"""
+
+import numpy as np
+
+from . import profiling
+from .tree import ExtTree, leaf_data
+from .treecut import collapse_nodes
+
+
+# odd 64-bit constants of splitmix64
+M0 = np.uint64(0x9E3779B97F4A7C15)
+M1 = np.uint64(0xBF58476D1CE4E5B9)
+M2 = np.uint64(0x94D049BB133111EB)
+
+_shared = {}
+
+
+class LeafNames(object):
+    """ Integer ids of the leaf names, the same in every tree.
+    """
+
+    def __init__(self, names=()):
+        self.ids = {}
+        self.names = []
+        self.intern(names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, names):
+        ids = self.ids
+        res = []
+        for x in names:
+            i = ids.get(x)
+            if i is None:
+                i = ids[x] = len(self.names)
+                self.names.append(x)
+            res.append(i)
+        return np.array(res, dtype=np.int64)
+
+
+def leaf_hashes(ids):
+    """ 64-bit hashes of the leaf ids (splitmix64).
+    """
+    with np.errstate(over="ignore"):
+        z = ids.astype(np.uint64) * M0 + M0
+        z = (z ^ (z >> np.uint64(30))) * M1
+        z = (z ^ (z >> np.uint64(27))) * M2
+        return z ^ (z >> np.uint64(31))
+
+
+def signatures(ids, starts, ends):
+    """
+    Signatures of the leaf sets [start, end) of a tree whose leaves have the
+    interned `ids`, mixed with the set sizes.
+
+    >>> a = signatures(np.array([3, 1, 2]), np.array([0, 1]), np.array([2, 3]))
+    >>> b = signatures(np.array([2, 1, 3]), np.array([1, 0]), np.array([3, 2]))
+    >>> list(a == b)
+    [True, True]
+    """
+    prefix = np.zeros(len(ids) + 1, dtype=np.uint64)
+    np.bitwise_xor.accumulate(leaf_hashes(ids), out=prefix[1:])
+    return prefix[ends] ^ prefix[starts] ^ leaf_hashes(ends - starts)
+
+
+def init_worker(state, parent=False):
+    # the workers neither profile nor report progress, the parent does
+    if not parent:
+        profiling.stop()
+    _shared.clear()
+    _shared.update(state)
+
+
+def score_tree(args):
+    """ Signatures of the modules and of all the clades of one tree, whose
+    leaves have the interned `ids`.
+    """
+    index, ids = args
+    s = _shared
+    collapsed = collapse_nodes(index, support_cutoff=s["support_cutoff"])
+    if collapsed.origin is not None:
+        ids = ids[index.start[collapsed.origin[collapsed.leaf_nodes]]]
+    index = collapsed
+    data, categories = s["data"]
+    rows = np.minimum(ids, s["nvalued"])
+    t = ExtTree(index, s["values"], None, datatype=s["datatype"],
+                prune=s["prune"], test=s["test"],
+                leaf_data=(data[rows], categories))
+
+    starts, ends = t.intervals(t.get_modules(cutoff=s["cutoff"]))
+    clades = index.internal_nodes[1:]
+    return signatures(ids, starts, ends), \
+           signatures(ids, index.start[clades], index.end[clades])
+
+
+def module_stability(t, trees, cutoff=.05, support_cutoff=.5, prune=None,
+                     jobs=1):
+    """
+    How often the modules of the ExtTree `t` (at `cutoff`) come back in the
+    ensemble of `trees` (TreeIndex), with the values and the test of `t`.
+    Returns the modules, and for each the number of trees where its leaf set
+    is a clade and where it is a module, out of the number of trees.
+    """
+    values, datatype = t.values, t.datatype
+    names = LeafNames(sorted(values))
+    nvalued = len(names)
+    # the row after the valued accessions is the missing value
+    data = leaf_data(names.names + [None], values, datatype)
+
+    modules = t.get_modules(cutoff=cutoff)
+    starts, ends = t.intervals(modules)
+    reference = signatures(names.intern(t.index.leaves), starts, ends)
+
+    tasks = [(index, names.intern(index.leaves)) for index in trees]
+    state = dict(data=data, nvalued=nvalued, values=values,
+                 datatype=datatype, test=t.arrays.test, cutoff=cutoff,
+                 support_cutoff=support_cutoff, prune=prune)
+    clades = np.zeros(len(modules), dtype=np.int64)
+    recovered = np.zeros(len(modules), dtype=np.int64)
+    progress = profiling.progress(len(tasks), label="trees")
+    pool = None
+    if jobs > 1:
+        import multiprocessing as mp
+        pool = mp.Pool(jobs, initializer=init_worker, initargs=(state,))
+        results = pool.imap(score_tree, tasks, chunksize=1)
+    else:
+        init_worker(state, parent=True)
+        results = (score_tree(x) for x in tasks)
+    try:
+        for i, (module_sigs, clade_sigs) in enumerate(results):
+            clades += np.in1d(reference, clade_sigs)
+            recovered += np.in1d(reference, module_sigs)
+            progress.update(i + 1)
+    finally:
+        progress.close()
+        if pool:
+            pool.close()
+            pool.join()
+    profiling.count("trees_scored", len(tasks))
+    return modules, clades, recovered, len(tasks)
+
+
+def print_stability(filehandle, modules, clades, recovered, ntrees):
+    """ The modules as in print_modules, followed by the fractions of the
+    trees where their leaf set is a clade and a module.
+    """
+    ntrees = float(max(ntrees, 1))
+    for e, c, r in zip(modules, clades.tolist(), recovered.tolist()):
+        print >>filehandle, "%s\t%s\t%s\t%.1g\t%.3g\t%.3g" % \
+                (",".join(sorted(e.get_leaf_names())), e.desc, e.note, e.val,
+                 c / ntrees, r / ntrees)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+On-disk cache of the node tests, so that re-running the same tree and values
+(with another --cutoff, or --printall) skips the parsing, the collapsing and
+the tests.
+
+Entries are keyed by the hashes of the tree file and of the values file, and
+by the options that change the P-values. Each entry is an .npz file with the
+collapsed tree (parent, names, branch lengths and supports) and the P-value,
+note, hi_min and lo_min of every internal node. The least recently used
+entries are evicted when the cache grows above its size cap.
+"""
+
+import hashlib
+import os
+import os.path as op
+import tempfile
+
+import numpy as np
+
+from index import TreeIndex
+
+
+CACHE_DIR = os.environ.get("TREECUT_CACHE",
+                           op.join(op.expanduser("~"), ".cache", "treecut"))
+CACHE_VERSION = 1
+
+
+def file_digest(filename, blocksize=1 << 20):
+    h = hashlib.sha1()
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(blocksize), ""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def pack_strings(strings):
+    return np.array(bytearray("\n".join(strings)), dtype=np.uint8)
+
+
+def unpack_strings(a, n):
+    return a.tostring().split("\n") if n else []
+
+
+class ResultCache(object):
+
+    def __init__(self, path=CACHE_DIR, maxsize=256 << 20):
+        self.path = path
+        self.maxsize = maxsize
+
+    def key(self, treefile, listfile, **options):
+        """ Content address of a run: the hashes of both input files and the
+        options, in sorted order.
+        """
+        h = hashlib.sha1("treecut-%d" % CACHE_VERSION)
+        for filename in (treefile, listfile):
+            h.update(file_digest(filename))
+        for name, value in sorted(options.items()):
+            h.update("\t%s=%r" % (name, value))
+        return h.hexdigest()
+
+    def filename(self, key):
+        return op.join(self.path, key + ".npz")
+
+    def get(self, key):
+        """ Returns (index, results) for a cached run, or None.
+        """
+        filename = self.filename(key)
+        try:
+            with open(filename, "rb") as fp:
+                entry = np.load(fp)
+                index = TreeIndex(entry["parent"],
+                        unpack_strings(entry["names"], len(entry["parent"])),
+                        dist=entry["dist"], support=entry["support"])
+                results = dict((x, entry[x]) for x in \
+                                ("val", "hi_min", "lo_min"))
+                results["note"] = unpack_strings(entry["note"],
+                                                 len(entry["val"]))
+        except (IOError, KeyError, ValueError):
+            return None
+
+        # the modification time tells the recently used entries
+        os.utime(filename, None)
+        return index, results
+
+    def put(self, key, index, results):
+        if not op.isdir(self.path):
+            os.makedirs(self.path)
+        fd, tmpfile = tempfile.mkstemp(suffix=".npz", dir=self.path)
+        with os.fdopen(fd, "wb") as fp:
+            np.savez(fp, parent=index.parent, names=pack_strings(index.names),
+                     dist=index.dist, support=index.support,
+                     val=results["val"], hi_min=results["hi_min"],
+                     lo_min=results["lo_min"],
+                     note=pack_strings(results["note"]))
+        # readers never see a partial file
+        os.rename(tmpfile, self.filename(key))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """ Remove the least recently used entries above the size cap.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".npz") or name.startswith("tmp") or \
+                    name == "%s.npz" % keep:
+                continue
+            filename = op.join(self.path, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+
+        total = sum(x[1] for x in entries)
+        if keep is not None and op.exists(self.filename(keep)):
+            total += op.getsize(self.filename(keep))
+        for mtime, size, filename in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
@@ -1,14 +1,19 @@
 """
 Draws vertically presented hierarchical tree, along with the associated values
-"""
 
-import itertools
+With a level-of-detail threshold (lod, in pixels), the subtrees narrower than
+lod that neither are nor contain a module are drawn as filled wedges, and the
+values are drawn as an image strip of one column per pixel, so that the number
+of drawn shapes does not grow with the number of leaves.
+"""
 
 import numpy as np
 import numpy.ma as ma
 import random
 import matplotlib
 matplotlib.use("Agg")
+from matplotlib.collections import LineCollection, PatchCollection, \
+            PolyCollection
 from matplotlib.patches import Rectangle
 import matplotlib.pyplot as plt
 
@@ -25,22 +30,30 @@ def clear_ax(ax):
 
 class Dendrogram(object):
 
-    def __init__(self, ext_tree, datatype="continuous", cutoff=.05, **kwargs):
+    def __init__(self, ext_tree, datatype="continuous", cutoff=.05, lod=0,
+                 dpi=None, **kwargs):
 
         self.tree = ext_tree
         self.accessions = []
         self.values = self.tree.values
         self.xinterval = 0
         self.datatype = datatype
+        self.modules = self.tree.get_modules(cutoff=cutoff)
 
         self.figure = fig = plt.figure(1, (8,6))
         root = fig.add_axes([0,0,1,1])
         tree_ax = fig.add_axes([0,.5,1,.5])
         value_ax = fig.add_axes([0,.3,1,.2])
 
+        # pixels per unit of the axes coordinates
+        self.lod = lod
+        self.dpi = dpi or fig.dpi
+        self.xpixels = fig.get_figwidth() * self.dpi
+        self.ypixels = .2 * fig.get_figheight() * self.dpi
+
         self.draw_tree(tree_ax)
         self.draw_values(value_ax)
-        self.draw_modules(value_ax, cutoff=cutoff)
+        self.draw_modules(value_ax)
         self.draw_legend(root)
 
         for a in (tree_ax, value_ax, root):
@@ -55,8 +68,9 @@ class Dendrogram(object):
 
     def draw_tree(self, ax):
 
-        t = self.tree.node
-        farthest, max_dist = t.get_farthest_leaf()
+        t = self.tree.index
+        depths = t.get_depths()
+        max_dist = depths[t.leaf_nodes].max()
 
         margin = .1
         xstart = margin
@@ -65,33 +79,77 @@ class Dendrogram(object):
         # scale the tree
         scale = canvas / max_dist
 
-        num_leaves = len(t.get_leaf_names())
+        num_leaves = t.nleaves
         self.xinterval = xinterval = canvas / (num_leaves - 1)
-
-        coords = {}
-        i = itertools.count()
-        for n in t.traverse("postorder"):
-            dist = n.get_distance(t)
-            yy = ystart - scale * dist
-
-            if n.is_leaf():
-                xx = xstart + i.next() * xinterval
-                self.accessions.append(n.name)
-            else:
-                children = [coords[x] for x in n.get_children()]
-                children_x, children_y = zip(*children)
-                min_x, max_x = min(children_x), max(children_x)
-                # plot the horizontal bar
-                ax.plot((min_x, max_x), (yy, yy), "k-")
-                # plot the vertical bar
-                for cx, cy in children:
-                    ax.plot((cx, cx), (cy, yy), "k-")
-                xx = np.mean(children_x)
-
-            coords[n] = (xx, yy)
+        self.accessions = list(t.leaves)
+
+        # leaves are evenly spaced, parents centered over their children,
+        # children come after their parents in preorder
+        xs = np.zeros(len(t))
+        xs[t.leaf_nodes] = xstart + np.arange(num_leaves) * xinterval
+        ys = ystart - scale * depths
+        xlist, xsum = xs.tolist(), [0.] * len(t)
+        plist, nchildren = t.parent.tolist(), np.diff(t.child_ptr).tolist()
+        for v in xrange(len(t) - 1, -1, -1):
+            if nchildren[v]:
+                xlist[v] = xsum[v] / nchildren[v]
+            if v:
+                xsum[plist[v]] += xlist[v]
+        xs = np.array(xlist)
+
+        # subtrees collapsed into wedges, and the nodes below them
+        wedges = np.zeros(len(t), dtype=bool)
+        if self.lod:
+            wedges = self.get_wedges(xinterval)
+        hidden = np.r_[False, wedges[t.parent[1:]]]
+
+        # the vertical bars above every node, and the horizontal bars from
+        # the first to the last child of every internal node
+        v = np.flatnonzero(~hidden)[1:]
+        vbars = np.column_stack((xs[v], ys[v], xs[v], ys[t.parent[v]]))
+        n = np.flatnonzero(~t.is_leaf & ~wedges)
+        first = t.child_idx[t.child_ptr[n]]
+        last = t.child_idx[t.child_ptr[n + 1] - 1]
+        hbars = np.column_stack((xs[first], ys[n], xs[last], ys[n]))
+        segments = np.vstack((hbars, vbars)).reshape(-1, 2, 2)
+        ax.add_collection(LineCollection(segments, colors="k",
+                                         capstyle="projecting"),
+                          autolim=False)
+
+        # wedges from the subtree root to its first and last leaves, at the
+        # depth of its deepest leaf
+        polygons = []
+        for v in np.flatnonzero(wedges & ~hidden):
+            s, e = t.start[v], t.end[v]
+            bottom = ystart - scale * depths[v:v + t.size[v]].max()
+            x0 = xstart + s * xinterval
+            x1 = xstart + (e - 1) * xinterval
+            polygons.append(((xs[v], ys[v]), (x0, bottom), (x1, bottom)))
+        if polygons:
+            ax.add_collection(PolyCollection(polygons, facecolors="k",
+                                             edgecolors="k", linewidths=.5),
+                              autolim=False)
 
         ax.text(xstart*.5, .5, "Phylogeny", label_style)
 
+    def get_wedges(self, xinterval):
+        """
+        Internal nodes narrower than lod pixels, which neither are nor
+        contain a module of at least lod pixels. The nodes below a wedge are
+        wedges too.
+        """
+        t = self.tree.index
+        width = (t.end - t.start - 1) * xinterval * self.xpixels
+
+        # count the modules in [v, v + size) from the preorder positions
+        nmodules = np.zeros(len(t) + 1, dtype=np.int64)
+        ids = np.array([e.id for e in self.modules], dtype=np.int64)
+        nmodules[ids[width[ids] >= self.lod] + 1] = 1
+        nmodules = np.cumsum(nmodules)
+        v = np.arange(len(t))
+        keep = nmodules[v + t.size] > nmodules[v]
+        return ~t.is_leaf & ~keep & (width < self.lod)
+
     def draw_values(self, ax):
 
         margin = .1
@@ -99,6 +157,13 @@ class Dendrogram(object):
         ystart = .4
         xinterval = self.xinterval
 
+        # base line
+        ax.plot((xstart, 1-xstart), (ystart, ystart), "-", color="gray", lw=3)
+        ax.text(xstart*.5, .6, "Values", label_style)
+
+        # categories are not drawn, and need not be numbers
+        if self.datatype=="discrete": return
+
         # mask array for missing data
         num_leaves = len(self.accessions)
         mask = np.zeros(num_leaves, dtype=int)
@@ -108,11 +173,6 @@ class Dendrogram(object):
         accession_values = ma.array([self.values.get(x, -1) \
                 for x in self.accessions], mask=mask, dtype="f")
         min_val, max_val = accession_values.min(), accession_values.max()
-        # base line
-        ax.plot((xstart, 1-xstart), (ystart, ystart), "-", color="gray", lw=3)
-        ax.text(xstart*.5, .6, "Values", label_style)
-
-        if self.datatype=="discrete": return
 
         # draw the gauge to the right showing the data range
         gauge, tip = 1-margin*.7, .005
@@ -127,39 +187,84 @@ class Dendrogram(object):
         accession_values -= min_val
         accession_values *= scale
 
-        for i, a in enumerate(accession_values):
-            xx = xstart + i * xinterval
-            if accession_values[i] is ma.masked:
-                ax.text(xx, ystart, r"$\ast$", ha="center", va="top", color="r")
-            else:
-                ax.plot((xx, xx), (ystart, ystart + a), "-", color="gray", lw=2)
-
-    def draw_modules(self, ax, cutoff=.05):
+        xx = xstart + np.arange(num_leaves) * xinterval
+        present = ~mask.astype(bool)
+        if self.lod:
+            self.draw_strip(ax, xx, accession_values.filled(0), present)
+            return
+
+        bars = np.column_stack((xx, np.repeat(ystart, num_leaves), xx,
+                                ystart + accession_values.filled(0)))
+        ax.add_collection(LineCollection(bars[present].reshape(-1, 2, 2),
+                                         colors="gray", linewidths=2,
+                                         capstyle="projecting"),
+                          autolim=False)
+        if not present.all():
+            ax.plot(xx[~present], np.repeat(ystart - .06, (~present).sum()),
+                    ls="none", marker=r"$\ast$", color="r")
+
+    def draw_strip(self, ax, xx, heights, present):
+        """
+        Value bars as an image, one column per pixel with the highest bar
+        of its leaves. Columns with only missing values are marked.
+        """
+        margin = .1
+        xstart = margin
+        ystart = .4
+        ncols = max(int(round((1 - 2 * margin) * self.xpixels)), 1)
+        nrows = max(int(round((1 - ystart) * self.ypixels)), 1)
+
+        col = np.round((xx - xstart) / (1 - 2 * margin) * (ncols - 1))
+        col = col.astype(np.int64)
+        top = np.zeros(ncols)
+        cp = col[present]
+        if len(cp):
+            first = np.flatnonzero(np.r_[True, cp[1:] != cp[:-1]])
+            top[cp[first]] = np.maximum.reduceat(heights[present], first)
+
+        rows = (np.arange(nrows) + .5) / nrows * (1 - ystart)
+        image = np.zeros((nrows, ncols, 4))
+        image[rows[:, None] < top[None, :]] = (.5, .5, .5, 1)
+        ax.imshow(image, extent=(xstart, 1 - xstart, ystart, 1),
+                  origin="lower", aspect="auto", interpolation="nearest")
+
+        missing = np.setdiff1d(col[~present], cp)
+        if len(missing):
+            mx = xstart + missing * (1 - 2 * margin) / max(ncols - 1, 1)
+            ax.plot(mx, np.repeat(ystart - .06, len(missing)),
+                    ls="none", marker=r"$\ast$", color="r")
+
+    def draw_modules(self, ax):
 
         margin = .1
         xstart = margin
         ystart = .4
         xinterval = self.xinterval
 
-        modules = self.tree.get_modules(cutoff=cutoff)
-        lmean = np.mean
+        modules = self.modules
+        start, end = self.tree.index.start, self.tree.index.end
 
         if self.datatype=="discrete":
             mcolors = dict((x.note, random.choice("rgbmcky")) for x in modules)
 
+        patches = []
         for e in modules:
             if self.datatype=="continuous":
-                mcolor = "g" if lmean(e.a) < lmean(e.b) else "r"
+                mcolor = "g" if e.desc == "lo" else "r"
             else:
                 mcolor = mcolors[e.note]
 
-            accs = e.get_leaf_names()
-            xx = xstart + min(self.accessions.index(x) for x in accs) * xinterval
-            width = (len(accs) - 1) * xinterval
-            ax.add_patch(Rectangle((xx, ystart), width, 1-ystart, fc=mcolor, alpha=.3, lw=0))
+            # leaves of a node are the interval of the leaf order from start
+            xx = xstart + start[e.id] * xinterval
+            width = (end[e.id] - start[e.id] - 1) * xinterval
+            patches.append(Rectangle((xx, ystart), width, 1-ystart, fc=mcolor, alpha=.3, lw=0))
+            if width * self.xpixels < self.lod:
+                continue
             note = r"$\bar{x}=%s$" % e.note if self.datatype=="continuous" else _(e.note)
             ax.text(xx+width*.5, ystart-.05, note, color=mcolor, ha="center", va="top")
             ax.text(xx+width*.5, ystart-.15, r"$(P=%.1g)$" % e.val, color=mcolor, ha="center", va="top")
+        ax.add_collection(PatchCollection(patches, match_original=True),
+                          autolim=False)
 
     def savefig(self, image_name, **kwargs):
 
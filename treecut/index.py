@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+TreeIndex is a flat, array-backed representation of the tree topology.
+
+Nodes are numbered in preorder, so the descendants of node v occupy the ids
+[v, v + size[v]). Leaves are kept in DFS order, and every node covers the
+contiguous leaf interval [start[v], end[v]) of that order. All per-node
+queries (leaf names, group sizes, children) become slices instead of walks.
+"""
+
+import numpy as np
+
+
+class TreeIndex(object):
+
+    def __init__(self, parent, names, dist=None, support=None):
+        """
+        `parent` lists the parent id of every node, where the nodes are
+        numbered in preorder (the root is 0 and has parent -1, and the
+        children of a node are listed in their original order).
+        """
+        self.parent = parent = np.asarray(parent, dtype=np.int64)
+        self.names = list(names)
+        n = len(parent)
+        self.dist = np.ones(n) if dist is None else np.asarray(dist, dtype=float)
+        self.support = np.ones(n) if support is None else \
+                        np.asarray(support, dtype=float)
+
+        # children in CSR layout, preserving preorder within each parent
+        nchildren = np.bincount(parent[1:], minlength=n)
+        self.child_ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(nchildren, out=self.child_ptr[1:])
+        self.child_idx = np.argsort(parent[1:], kind="mergesort") + 1
+
+        self.is_leaf = nchildren == 0
+        leaf_nodes = np.flatnonzero(self.is_leaf)
+        self.leaves = [self.names[x] for x in leaf_nodes]
+
+        # subtree sizes (in nodes and in leaves), accumulated bottom-up
+        size = np.ones(n, dtype=np.int64)
+        nleaves = self.is_leaf.astype(np.int64)
+        psize, pleaves = size.tolist(), nleaves.tolist()
+        plist = parent.tolist()
+        for v in xrange(n - 1, 0, -1):
+            p = plist[v]
+            psize[p] += psize[v]
+            pleaves[p] += pleaves[v]
+        self.size = np.array(psize, dtype=np.int64)
+
+        leafcum = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(self.is_leaf, out=leafcum[1:])
+        self.start = leafcum[:-1]
+        self.end = self.start + np.array(pleaves, dtype=np.int64)
+        self.leaf_nodes = leaf_nodes
+        # ids of the nodes in the tree this one was collapsed from
+        self.origin = None
+
+    @classmethod
+    def from_ete(cls, tree):
+        """ Build the index from an ete2 tree in one preorder walk.
+        """
+        ids = {}
+        parent, names, dist, support = [], [], [], []
+        for i, node in enumerate(tree.traverse("preorder")):
+            ids[node] = i
+            parent.append(ids[node.up] if i else -1)
+            names.append(node.name)
+            dist.append(node.dist)
+            support.append(node.support)
+        return cls(parent, names, dist=dist, support=support)
+
+    @classmethod
+    def from_children(cls, children, names, dist=None, support=None, root=0):
+        """
+        Build the index from lists of child ids, renumbering the nodes that
+        are reachable from `root` in preorder. The other lists are indexed by
+        the old ids.
+        """
+        order, parent = [], []
+        stack = [(root, -1)]
+        while stack:
+            v, p = stack.pop()
+            parent.append(p)
+            p = len(order)
+            order.append(v)
+            stack.extend((c, p) for c in reversed(children[v]))
+
+        names = [names[v] for v in order]
+        dist = None if dist is None else np.asarray(dist, dtype=float)[order]
+        support = None if support is None else \
+                    np.asarray(support, dtype=float)[order]
+        return cls(parent, names, dist=dist, support=support)
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def nleaves(self):
+        return len(self.leaves)
+
+    @property
+    def internal_nodes(self):
+        """ Internal node ids, in preorder.
+        """
+        return np.flatnonzero(~self.is_leaf)
+
+    def children(self, v):
+        return self.child_idx[self.child_ptr[v]:self.child_ptr[v + 1]]
+
+    def get_leaf_names(self, v=0):
+        return self.leaves[self.start[v]:self.end[v]]
+
+    def get_depths(self):
+        """ Cumulative branch length from the root to every node.
+        """
+        depth = [0.] * len(self)
+        plist, dist = self.parent.tolist(), self.dist.tolist()
+        for v in xrange(1, len(self)):
+            depth[v] = depth[plist[v]] + dist[v]
+        return np.array(depth)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Modules of a tree for every P-value cutoff at once.
+
+A node is a module at `cutoff` when its P-value is below its hi_min, its
+lo_min and the cutoff. Two such nodes are never nested: the upper one would
+need a P-value below the lower one's, and the lower one a P-value below the
+upper one's. So the "no module above" rule never removes anything, the
+cutoff only decides how many of the candidates are in, and raising it adds
+the candidates in the order of their P-values. ModulePath keeps them in that
+order, and modules(cutoff) is a binary search.
+"""
+
+import numpy as np
+
+
+class ModulePath(object):
+
+    def __init__(self, val, hi_min, lo_min):
+        hit = val < np.minimum(hi_min, lo_min)
+        hit[0] = False
+        nodes = np.flatnonzero(hit)
+        order = np.argsort(val[nodes], kind="mergesort")
+        # the candidates by increasing P-value, the root excluded
+        self.nodes = nodes[order]
+        self.pvalues = val[self.nodes]
+        self.size = len(val)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def count(self, cutoff):
+        """ Number of modules at `cutoff` (or at each of an array of them).
+        """
+        return np.searchsorted(self.pvalues, cutoff, side="left")
+
+    def modules(self, cutoff):
+        """ Positions of the modules at `cutoff`, in preorder.
+        """
+        return np.sort(self.nodes[:self.count(cutoff)])
+
+    def mask(self, cutoff):
+        hit = np.zeros(self.size, dtype=bool)
+        hit[self.nodes[:self.count(cutoff)]] = True
+        return hit
+
+    def table(self):
+        """
+        Columns of the cutoff table, one row per candidate by increasing
+        P-value: node `node_id` is a module for every cutoff above `cutoff`,
+        where there are `nmodules` of them.
+        """
+        return dict(cutoff=self.pvalues, node_id=self.nodes,
+                    nmodules=self.count(np.nextafter(self.pvalues, np.inf)))
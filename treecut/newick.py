@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Streaming Newick reader that builds the TreeIndex directly, without creating
+a node object per clade. The format codes, default values and checks follow
+the ete2 parser (see the treecut.py docstring for the list of formats).
+"""
+
+import os.path as op
+import re
+
+from index import TreeIndex
+
+
+DEFAULT_DIST = 1.0
+DEFAULT_SUPPORT = 1.0
+
+# data held by the leaf and the internal labels, as "first:second"
+NW_FORMAT = {
+    #    leaf first, leaf second, internal first, internal second, flexible
+    0: ("name", "dist", "support", "dist", True),
+    1: ("name", "dist", "name", "dist", True),
+    2: ("name", "dist", "support", "dist", False),
+    3: ("name", "dist", "name", "dist", False),
+    4: ("name", "dist", None, None, False),
+    5: ("name", "dist", None, "dist", False),
+    6: ("name", None, None, "dist", False),
+    7: ("name", "dist", "name", None, False),
+    8: ("name", None, "name", None, False),
+    9: ("name", None, None, None, False),
+    100: (None, None, None, None, False),
+}
+
+_TOKEN_RE = re.compile(r"[(),;]|[^(),;]+")
+_COMMENT_RE = re.compile(r"\[[^\]]*\]|[\n\r\t]+")
+
+
+class NewickError(Exception):
+    pass
+
+
+def parse_label(label, first, second, flexible, leaf=False):
+    """
+    Reads "first:second" from a node label, and returns (name, support, dist)
+    where None means that the default applies.
+
+    >>> parse_label("D:0.72", "name", "dist", True, leaf=True)
+    ('D', None, 0.72)
+    >>> parse_label("0.95:0.06", "support", "dist", True)
+    (None, 0.95, 0.06)
+    """
+    label = _COMMENT_RE.sub("", label).strip()
+    values = {"name": None, "support": None, "dist": None}
+    if not label:
+        return None, None, None
+
+    a, colon, b = label.partition(":")
+    a, b = a.strip(), b.strip() if colon else None
+    # leaves always need the first part, and strict formats the second
+    for kind, text, optional in ((first, a, flexible and not leaf),
+                                 (second, b, flexible)):
+        if kind is None:
+            if text:
+                raise NewickError("Unexpected newick format '%s'" % label)
+            continue
+        if not text:
+            if optional:
+                continue
+            raise NewickError("Unexpected newick format '%s'" % label)
+        if kind == "name":
+            values[kind] = text
+        else:
+            try:
+                values[kind] = float(text)
+            except ValueError:
+                raise NewickError("Unexpected newick format '%s'" % label)
+
+    return values["name"], values["support"], values["dist"]
+
+
+def iter_tokens(fp, blocksize=1 << 20):
+    """ Split a Newick stream into parentheses, commas, semicolons and labels.
+    """
+    rest = ""
+    while True:
+        block = fp.read(blocksize)
+        if not block:
+            break
+        block = rest + block
+        # a label may continue into the next block
+        cut = max(block.rfind(x) for x in "(),;") + 1
+        block, rest = block[:cut], block[cut:]
+        for token in _TOKEN_RE.findall(block):
+            yield token
+    if rest.strip():
+        yield rest
+
+
+def open_newick(newick):
+    """ File object of a file name, a file object or a Newick string.
+    """
+    if hasattr(newick, "read"):
+        return newick
+    if op.exists(newick):
+        return open(newick)
+    from StringIO import StringIO
+    return StringIO(newick)
+
+
+def read_newick(newick, format=0):
+    """
+    Reads a Newick tree from a file name, a file object or a string, and
+    returns its TreeIndex. Nodes are numbered as they are opened, which is the
+    preorder of the tree.
+
+    >>> t = read_newick("((D:0.7,F:0.5)0.9:0.06,(B:0.2,H:0.7)1.0:0.8);")
+    >>> t.leaves
+    ['D', 'F', 'B', 'H']
+    >>> list(t.parent), list(t.support)
+    ([-1, 0, 1, 1, 0, 4, 4], [1.0, 0.9, 1.0, 1.0, 1.0, 1.0, 1.0])
+    """
+    tokens = iter_tokens(open_newick(newick))
+    tree = parse_tree(tokens, format=format)
+    if tree is None:
+        raise NewickError("Missing ';' at the end of the tree")
+    for token in tokens:
+        if token.strip():
+            raise NewickError("Unexpected data after the end of the tree")
+    return tree
+
+
+def iter_newick(newick, format=0):
+    """
+    Reads the trees of a multi-tree Newick file (one tree per ';', as the
+    bootstrap replicates of PHYLIP), and yields their TreeIndex in order.
+
+    >>> [t.leaves for t in iter_newick("(A,(B,C)); ((A,B),C);")]
+    [['A', 'B', 'C'], ['A', 'B', 'C']]
+    """
+    tokens = iter_tokens(open_newick(newick))
+    while True:
+        tree = parse_tree(tokens, format=format)
+        if tree is None:
+            return
+        yield tree
+
+
+def parse_tree(tokens, format=0):
+    """
+    Builds the TreeIndex of the next tree from the tokens, up to its ';'.
+    Returns None when the tokens end before a tree starts.
+    """
+    if format not in NW_FORMAT:
+        raise NewickError("Unsupported newick format %s" % format)
+    leaf_first, leaf_second, first, second, flexible = NW_FORMAT[format]
+
+    parent, names, dist, support = [], [], [], []
+    stack = []
+
+    def add_node(label, leaf):
+        if leaf:
+            if not label.strip() and format != 100:
+                raise NewickError("Empty leaf node found")
+            name, sup, d = parse_label(label, leaf_first, leaf_second,
+                                       flexible, leaf=True)
+        else:
+            name, sup, d = None, None, None
+        # the root has no branch above it, unless it was given one
+        if d is None:
+            d = DEFAULT_DIST if parent else 0.0
+        parent.append(stack[-1] if stack else -1)
+        names.append(name or "")
+        dist.append(d)
+        support.append(DEFAULT_SUPPORT if sup is None else sup)
+
+    expect_leaf = False  # after "(" and ",", a label starts a new leaf
+    closed = None        # the internal node that was closed last
+    label = ""
+    done = False
+    for token in tokens:
+        if token == "(":
+            if label.strip() or (stack and not expect_leaf):
+                raise NewickError("Broken newick structure at '('")
+            add_node("", False)
+            stack.append(len(parent) - 1)
+            expect_leaf = True
+            label = ""
+        elif token in ",);":
+            if expect_leaf:
+                if token == ";":
+                    raise NewickError("Parentheses do not match")
+                add_node(label, True)
+            elif closed is not None and label.strip():
+                name, sup, d = parse_label(label, first, second, flexible)
+                if name is not None:
+                    names[closed] = name
+                if sup is not None:
+                    support[closed] = sup
+                if d is not None:
+                    dist[closed] = d
+            elif not parent and token == ";":
+                # a single node, as in "A;"
+                add_node(label, True)
+            elif label.strip():
+                raise NewickError("Unexpected newick format '%s'" % label)
+            label = ""
+
+            if token == ",":
+                if not stack:
+                    raise NewickError("Broken newick structure at ','")
+                expect_leaf = True
+            elif token == ")":
+                if not stack:
+                    raise NewickError("Parentheses do not match")
+                closed = stack.pop()
+                expect_leaf = False
+            else:
+                if stack:
+                    raise NewickError("Parentheses do not match")
+                done = True
+                break
+        else:
+            label += token
+
+    if not done:
+        if not parent and not label.strip():
+            return None
+        raise NewickError("Missing ';' at the end of the tree")
+    if len(parent) > 1 and closed != 0:
+        raise NewickError("Malformed newick tree structure")
+
+    return TreeIndex(parent, names, dist=dist, support=support)
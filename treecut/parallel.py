@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Runs the node-level statistical tests on a pool of processes.
+
+The leaf values (or the leaf x category matrix) and the node intervals are
+copied once into shared memory when the pool starts, so the workers only get
+the bounds of the chunk of nodes to test, and send back the P-values.
+"""
+
+import numpy as np
+
+import profiling
+from stats import test_continuous_all, test_discrete_all
+
+
+_shared = {}
+
+
+def share(a):
+    """ Copy an array into shared memory, to be restored with unshare().
+    """
+    from multiprocessing.sharedctypes import RawArray
+
+    a = np.ascontiguousarray(a)
+    buf = RawArray("b", max(a.nbytes, 1))
+    np.frombuffer(buf, dtype=a.dtype, count=a.size)[:] = a.ravel()
+    return buf, a.dtype.str, a.shape
+
+
+def unshare(buf, dtype, shape):
+    count = int(np.prod(shape))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+
+def init_worker(arrays):
+    # the workers neither profile nor report progress, the parent does
+    profiling.stop()
+    _shared.clear()
+    for key, args in arrays.items():
+        _shared[key] = unshare(*args)
+
+
+def test_chunk(args):
+    lo, hi, cutoff, test = args
+    starts, ends = _shared["starts"][lo:hi], _shared["ends"][lo:hi]
+    if "x" in _shared:
+        # whole leaf values in every chunk, the ranks are global
+        return test_continuous_all(_shared["x"], starts, ends, test=test)
+
+    from scipy import sparse
+    M = sparse.csr_matrix((_shared["data"], _shared["indices"],
+                           _shared["indptr"]),
+                          shape=tuple(int(x) for x in _shared["shape"]))
+    return test_discrete_all(M, starts, ends, cutoff=cutoff)
+
+
+def split_chunks(starts, ends, nchunks):
+    """
+    Cut the nodes into contiguous chunks of about the same total interval
+    length, which is what the discrete tests cost.
+
+    >>> split_chunks(np.array([0, 0, 2, 4]), np.array([8, 2, 4, 6]), 2)
+    [(0, 1), (1, 4)]
+    """
+    lengths = np.cumsum(ends - starts)
+    cuts = np.searchsorted(lengths, lengths[-1] * np.arange(1, nchunks) /
+                           float(nchunks)) + 1
+    bounds = np.unique(np.r_[0, cuts, len(starts)])
+    return zip(bounds[:-1], bounds[1:])
+
+
+def test_nodes_parallel(data, starts, ends, jobs, cutoff=None, test="ttest"):
+    """
+    Same as test_continuous_all with `test` (if `data` holds the leaf values) or
+    test_discrete_all (if `data` is the leaf x category matrix), run over
+    `jobs` processes. With a `cutoff`, subtrees are only pruned within each
+    chunk, so the modules are the same but fewer tests get skipped.
+    """
+    if not len(starts):
+        return np.ones(0), np.zeros(0)
+
+    arrays = {"starts": share(starts), "ends": share(ends)}
+    if not isinstance(data, np.ndarray):
+        arrays.update(data=share(data.data), indices=share(data.indices),
+                      indptr=share(data.indptr), shape=share(data.shape))
+    else:
+        arrays.update(x=share(data))
+
+    tasks = [(lo, hi, cutoff, test) for lo, hi in \
+                split_chunks(starts, ends, 4 * jobs)]
+    import multiprocessing as mp
+    pool = mp.Pool(jobs, initializer=init_worker, initargs=(arrays,))
+    progress = profiling.progress(len(starts))
+    results = []
+    try:
+        for r in pool.imap(test_chunk, tasks, chunksize=1):
+            results.append(r)
+            progress.update(tasks[len(results) - 1][1])
+    finally:
+        progress.close()
+        pool.close()
+        pool.join()
+
+    p_values, notes = zip(*results)
+    return np.concatenate(p_values), np.concatenate(notes)
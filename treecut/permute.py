@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Permutation tests for the node P-values.
+
+The values are shuffled among the leaves that have values, so the group sizes
+of every node stay the same, and all the node P-values are recomputed for each
+permutation. Permutations are processed in blocks: a block of continuous
+permutations is a leaf x permutation matrix for test_continuous_all, and a
+block of discrete permutations is one wide leaf x (permutation, category)
+matrix whose interval sums give the tables of all the nodes at once.
+
+Only running counts are kept, so the null distributions are never stored:
+how often each node is matched by its own permuted P-values (the empirical
+P-value), and the pooled null P-values of all the nodes below every observed
+P-value (for the node-level FDR).
+"""
+
+import numpy as np
+
+import profiling
+from stats import column_keys, fisher_engine, interval_costs, \
+            interval_counts, interval_sums, test_continuous_all
+
+
+def permuted_leaves(has, permutations, rng):
+    """
+    Leaf order of each permutation, as rows of a permutations x leaves array:
+    the leaves with values are shuffled, the others stay in place.
+    """
+    pos = np.flatnonzero(has)
+    idx = np.tile(np.arange(len(has)), (permutations, 1))
+    for row in idx:
+        row[pos] = pos[rng.permutation(len(pos))]
+    return idx
+
+
+def null_continuous(x, starts, ends, idx, test="ttest"):
+    """ Node x permutation matrix of the t-test (or `test`) P-values.
+    """
+    return test_continuous_all(x[idx.T], starts, ends, test=test)[0]
+
+
+def null_discrete(M, starts, ends, idx, chunksize=1 << 22, engine=fisher_engine):
+    """ Node x permutation matrix of the Bonferroni-corrected smallest
+    Fisher's exact P-values.
+    """
+    from scipy import sparse
+
+    nleaves, ncategories = M.shape
+    npermutations = len(idx)
+    has = np.diff(M.indptr) > 0
+    N = has.sum()
+    na = interval_sums(has, starts, ends).astype(np.int64)
+    totals = np.asarray(M.sum(axis=0)).ravel()
+    engine.reserve(N)
+
+    # the permuted matrices side by side, column p * ncategories + c
+    src = idx.ravel()
+    lengths = np.diff(M.indptr)[src]
+    offsets = np.cumsum(lengths) - lengths
+    ptr = np.repeat(M.indptr[src] - offsets, lengths) + np.arange(lengths.sum())
+    rows = np.repeat(np.tile(np.arange(nleaves), npermutations), lengths)
+    cols = np.repeat(np.arange(npermutations) * ncategories, nleaves)
+    cols = np.repeat(cols, lengths) + M.indices[ptr]
+    Ms = sparse.csr_matrix((np.ones(len(cols), dtype=np.int64), (rows, cols)),
+                           shape=(nleaves, npermutations * ncategories))
+
+    null = np.ones((len(starts), npermutations))
+    costs = np.cumsum(interval_costs(Ms, starts, ends))
+    total = int(costs[-1]) if len(costs) else 0
+    cuts = np.searchsorted(costs, chunksize *
+                np.arange(1, total // chunksize + 1), side="right")
+    bounds = np.unique(np.r_[0, cuts, len(starts)])
+    keys = column_keys(Ms)
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        counts = interval_counts(Ms, starts[lo:hi], ends[lo:hi], keys=keys)
+        rows = np.repeat(np.arange(hi - lo), np.diff(counts.indptr))
+        perms, categories = np.divmod(counts.indices, ncategories)
+        n, K = na[lo:hi][rows], totals[categories]
+        a1 = counts.data
+        p = engine.pvalues(a1, n - a1, K - a1, N - n - K + a1)
+
+        # pairs are sorted by node and permutation, one group per test
+        groups = rows * npermutations + perms
+        first = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        tested = np.diff(np.r_[first, len(groups)])
+        p = np.minimum.reduceat(p, first) * tested
+        null[lo + rows[first], perms[first]] = p
+
+    return null
+
+
+def permutation_test(data, starts, ends, observed, permutations=1000,
+                     seed=None, blocksize=None, test="ttest"):
+    """
+    Empirical P-values and node-level FDR of the nodes [start, end) with the
+    `observed` P-values. `data` holds the leaf values (NaN when missing), or
+    is the leaf x category matrix for discrete values; `test` is the
+    continuous test of the observed P-values.
+
+    The empirical P-value of a node is the fraction of permutations where its
+    P-value is at least as small as observed (counting the observed one). The
+    FDR at a node is the expected number of null P-values of all the nodes
+    below its observed P-value, divided by the number of observed ones, made
+    monotone as in q-values.
+    """
+    rng = np.random.RandomState(seed)
+    discrete = not isinstance(data, np.ndarray)
+    has = np.diff(data.indptr) > 0 if discrete else ~np.isnan(data)
+    m = len(starts)
+    if blocksize is None:
+        width = data.shape[1] if discrete else 1
+        blocksize = max(1, (1 << 22) // max(m * width, 1))
+
+    # ties in the recomputed P-values should not depend on rounding
+    observed = np.asarray(observed, dtype=float)
+    thresholds = observed * (1 + 1e-9)
+    order = np.argsort(thresholds, kind="mergesort")
+    sorted_thresholds = thresholds[order]
+
+    exceed = np.zeros(m, dtype=np.int64)
+    below = np.zeros(m + 1, dtype=np.int64)
+    done = 0
+    progress = profiling.progress(permutations, label="permutations")
+    while done < permutations:
+        block = min(blocksize, permutations - done)
+        idx = permuted_leaves(has, block, rng)
+        if discrete:
+            null = null_discrete(data, starts, ends, idx)
+        else:
+            null = null_continuous(data, starts, ends, idx, test=test)
+        exceed += (null <= thresholds[:, None]).sum(axis=1)
+        below += np.bincount(np.searchsorted(sorted_thresholds, null.ravel()),
+                             minlength=m + 1)
+        done += block
+        progress.update(done)
+    progress.close()
+
+    empirical = (exceed + 1.) / (permutations + 1)
+
+    # null P-values below each threshold, and observed discoveries
+    expected = np.cumsum(below)[:m] / float(permutations)
+    discoveries = np.searchsorted(np.sort(observed), sorted_thresholds,
+                                  side="right")
+    fdr = np.minimum(expected / np.maximum(discoveries, 1), 1)
+    fdr = np.minimum.accumulate(fdr[::-1])[::-1]
+
+    node_fdr = np.empty(m)
+    node_fdr[order] = fdr
+    return empirical, node_fdr
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Per-stage profiling and progress reporting.
+
+A Profiler records the wall time, the peak RSS and the counts (nodes tested,
+categories tested, cache hits) of every stage of a run. The library code
+reports to the active profiler through stage() and count(), which do nothing
+when no profiler was started, so the hooks cost nothing in normal runs.
+
+Long loops (the chunks of node tests, the permutation blocks) report through
+progress(), a rate-limited line of done and total with an ETA, shown only
+when start() was given progress=True.
+"""
+
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+
+def peak_rss():
+    """ Peak resident set size of this process so far, in kB.
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on Mac OS X, kB elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.stages = []
+        self.stack = []
+        self.counts = {}
+        self.start = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        """ Time a stage; nested stages are named "outer/inner".
+        """
+        if self.stack:
+            name = "%s/%s" % (self.stack[-1]["name"], name)
+        record = dict(name=name, counts={})
+        self.stages.append(record)
+        self.stack.append(record)
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.time() - start
+            record["peak_rss_kb"] = peak_rss()
+            self.stack.pop()
+
+    def count(self, name, n=1):
+        """ Add to a counter of the current stage (or of the run).
+        """
+        counts = self.stack[-1]["counts"] if self.stack else self.counts
+        counts[name] = counts.get(name, 0) + n
+
+    def report(self):
+        """ The stages in order, with the counts summed over the run.
+        """
+        totals = dict(self.counts)
+        for record in self.stages:
+            for name, n in record["counts"].items():
+                totals[name] = totals.get(name, 0) + n
+        return dict(stages=self.stages, counts=totals,
+                    seconds=time.time() - self.start,
+                    peak_rss_kb=peak_rss())
+
+    def write(self, filename):
+        with open(filename, "w") as fw:
+            json.dump(self.report(), fw, indent=1, sort_keys=True)
+
+
+class Progress(object):
+    """
+    Writes "[label] done/total (percent) ETA" to `stream`, at most once every
+    `interval` seconds (and once at the end). Without a stream, it is silent.
+    """
+
+    def __init__(self, total, label="nodes", stream=None, interval=1.):
+        self.total = total
+        self.label = label
+        self.stream = stream
+        self.interval = interval
+        self.start = self.last = time.time()
+        self.written = False
+
+    def update(self, done):
+        if self.stream is None:
+            return
+        now = time.time()
+        if done < self.total and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        if done:
+            eta = time.strftime("%H:%M:%S", time.gmtime(elapsed *
+                                (self.total - done) / done))
+        else:
+            eta = "--:--:--"
+        self.stream.write("\r[%s] %d/%d (%.0f%%) ETA %s" % (self.label, done,
+                          self.total, 100. * done / max(self.total, 1), eta))
+        self.stream.flush()
+        self.written = True
+
+    def close(self):
+        if self.written:
+            self.stream.write("\n")
+            self.stream.flush()
+            self.written = False
+
+
+_active = {"profiler": None, "progress": None}
+
+
+def start(profiler=None, progress=False, stream=None):
+    """ Make `profiler` the target of stage() and count(), and turn the
+    progress lines on (to stderr by default).
+    """
+    _active["profiler"] = profiler
+    _active["progress"] = (stream or sys.stderr) if progress else None
+    return profiler
+
+
+def stop():
+    _active["profiler"] = _active["progress"] = None
+
+
+@contextmanager
+def stage(name):
+    profiler = _active["profiler"]
+    if profiler is None:
+        yield None
+        return
+    with profiler.stage(name) as record:
+        yield record
+
+
+def count(name, n=1):
+    profiler = _active["profiler"]
+    if profiler is not None:
+        profiler.count(name, int(n))
+
+
+def progress(total, label="nodes"):
+    return Progress(total, label=label, stream=_active["progress"])
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+python treecut.py serve [options] name=treefile [name=treefile ...]
+
+Resident server: the named trees are parsed, collapsed and indexed once, and
+then every query (a set of values against one of the trees) only pays for the
+node tests. Queries are JSON objects:
+
+    {"tree": "flowering", "values": {"IS13": 57.2, ...}, "cutoff": 0.05}
+
+with "discrete": true for categories (lists, or strings separated by ";"),
+"prune": true as with --prune, and "test": "welch" or "ranksum" as --test.
+The answer lists the modules, with their leaves, description, note and
+P-value, and the time spent on the query.
+
+The server listens either on localhost HTTP (POST the query, GET /metrics or
+/trees), or on a Unix socket where each line is a JSON query and each answer
+is a line ({"command": "metrics"} and {"command": "trees"} give the others).
+Queries are answered by a pool of worker processes forked after the trees are
+loaded, so the workers share the indexes; the request timings are kept for
+/metrics. Client talks to either kind of server.
+"""
+
+import json
+import os
+import os.path as op
+import sys
+import threading
+import time
+from collections import deque
+from optparse import OptionParser
+
+import BaseHTTPServer
+import SocketServer
+
+from .batch import TraitScan
+from .stats import CONTINUOUS_TESTS
+from .tree import ExtTree
+from .treecut import collapse_nodes, read_tree
+
+
+DEFAULT_PORT = 8642
+
+# name => (index, scan) of the preloaded trees, inherited by the workers
+_trees = {}
+
+
+def add_tree(name, index):
+    _trees[name] = index, TraitScan(index)
+
+
+def load_tree(name, treefile, treeformat=0, support_cutoff=.5,
+              phylipconsense=False):
+    tree = read_tree(treefile, treeformat=treeformat)
+    add_tree(name, collapse_nodes(tree, support_cutoff=support_cutoff,
+                                  phylipconsense=phylipconsense))
+
+
+def answer(request):
+    """ Modules of the values of a query, on one of the preloaded trees.
+    """
+    start = time.time()
+    name = request.get("tree")
+    if name not in _trees:
+        raise KeyError("Unknown tree %r" % name)
+    index, scan = _trees[name]
+
+    discrete = bool(request.get("discrete"))
+    values = {}
+    for acc, value in request["values"].items():
+        if value is None:
+            continue
+        acc = str(acc)
+        if not discrete:
+            values[acc] = float(value)
+        elif isinstance(value, basestring):
+            values[acc] = str(value).split(";")
+        else:
+            values[acc] = [str(x) for x in value]
+
+    cutoff = float(request.get("cutoff", .05))
+    test = request.get("test", "ttest")
+    if test not in CONTINUOUS_TESTS:
+        raise ValueError("Unknown test %r" % test)
+    t = ExtTree(index, values, None,
+                datatype="discrete" if discrete else "continuous",
+                prune=cutoff if request.get("prune") else None, scan=scan,
+                test=test)
+    modules = [dict(leaves=e.get_leaf_names(), desc=e.desc, note=e.note,
+                    pvalue=float(e.val)) for e in t.get_modules(cutoff=cutoff)]
+    return dict(tree=name, modules=modules, seconds=time.time() - start)
+
+
+class Metrics(object):
+    """ Counts and latencies of the queries, the latest `window` of them for
+    the percentiles.
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = self.errors = 0
+        self.latencies = deque(maxlen=window)
+
+    def add(self, seconds, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += error
+            self.latencies.append(seconds)
+
+    def report(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            requests, errors = self.requests, self.errors
+        uptime = time.time() - self.start
+        pct = lambda q: 1000 * latencies[min(int(q * len(latencies)),
+                                             len(latencies) - 1)] \
+                        if latencies else 0
+        return dict(requests=requests, errors=errors, uptime=uptime,
+                    qps=requests / uptime if uptime else 0,
+                    mean_ms=1000 * sum(latencies) / len(latencies) \
+                            if latencies else 0,
+                    p50_ms=pct(.5), p95_ms=pct(.95), max_ms=pct(1))
+
+
+class Service(object):
+    """ Answers the requests, on a pool of `workers` processes (or in the
+    calling thread when workers is 0).
+    """
+
+    def __init__(self, workers=1, timeout=600):
+        self.timeout = timeout
+        self.metrics = Metrics()
+        self.pool = None
+        if workers > 0:
+            import multiprocessing as mp
+            self.pool = mp.Pool(workers)
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+    def handle(self, body):
+        """ Returns the HTTP status and the JSON answer of a request.
+        """
+        from multiprocessing import TimeoutError
+
+        start = time.time()
+        try:
+            request = json.loads(body)
+            command = request.get("command", "query")
+            if command == "metrics":
+                return 200, json.dumps(self.metrics.report())
+            if command == "trees":
+                return 200, json.dumps(dict((name, index.nleaves) \
+                                for name, (index, scan) in _trees.items()))
+            if self.pool:
+                result = self.pool.apply_async(answer, (request,)) \
+                                  .get(self.timeout)
+            else:
+                result = answer(request)
+            status = 200
+        except TimeoutError:
+            status, result = 504, dict(error="Timeout after %ss" % \
+                                             self.timeout)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            status, result = 400, dict(error=str(e))
+        except Exception as e:
+            status, result = 500, dict(error="%s: %s" % (type(e).__name__, e))
+        self.metrics.add(time.time() - start, error=status != 200)
+        return status, json.dumps(result)
+
+
+class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.reply(*self.server.service.handle(self.rfile.read(length)))
+
+    def do_GET(self):
+        command = self.path.strip("/")
+        if command not in ("metrics", "trees"):
+            self.reply(404, json.dumps(dict(error="Not found")))
+            return
+        self.reply(*self.server.service.handle(json.dumps(
+                                                dict(command=command))))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LineHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            if not line.strip():
+                continue
+            status, body = self.server.service.handle(line)
+            self.wfile.write(body + "\n")
+            self.wfile.flush()
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, socket=None, host="127.0.0.1", port=DEFAULT_PORT):
+    if socket:
+        if op.exists(socket):
+            os.remove(socket)
+        server = UnixServer(socket, LineHandler)
+    else:
+        server = HTTPServer((host, port), HTTPHandler)
+    server.service = service
+    return server
+
+
+class Client(object):
+    """
+    One connection to a server, at "host:port" (HTTP) or at the path of its
+    Unix socket.
+    """
+
+    def __init__(self, address):
+        if op.exists(address):
+            import socket
+            self.http = None
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+            self.fp = self.sock.makefile("rb")
+        else:
+            import httplib
+            host, _, port = address.rpartition(":")
+            self.http = httplib.HTTPConnection(host or "127.0.0.1", int(port))
+
+    def request(self, payload):
+        body = json.dumps(payload)
+        if self.http is None:
+            self.sock.sendall(body + "\n")
+            return json.loads(self.fp.readline())
+        self.http.request("POST", "/", body,
+                          {"Content-Type": "application/json"})
+        return json.loads(self.http.getresponse().read())
+
+    def query(self, tree, values, discrete=False, cutoff=.05, prune=False,
+              test="ttest"):
+        return self.request(dict(tree=tree, values=values, discrete=discrete,
+                                 cutoff=cutoff, prune=prune, test=test))
+
+    def metrics(self):
+        return self.request(dict(command="metrics"))
+
+    def close(self):
+        if self.http is None:
+            self.fp.close()
+            self.sock.close()
+        else:
+            self.http.close()
+
+
+def main(args):
+    p = OptionParser(__doc__)
+    p.add_option("--socket",
+            help="Listen on this Unix socket instead of HTTP")
+    p.add_option("--host", default="127.0.0.1",
+            help="HTTP address [default: %default]")
+    p.add_option("--port", type="int", default=DEFAULT_PORT,
+            help="HTTP port [default: %default]")
+    p.add_option("--workers", type="int", default=1,
+            help="Number of worker processes, 0 answers in the request "
+            "threads [default: %default]")
+    p.add_option("--timeout", type="float", default=600,
+            help="Seconds allowed per query [default: %default]")
+    p.add_option("--treeformat", type="int", default=0,
+            help="Format for Newick input trees [default: %default]")
+    p.add_option("--support_cutoff", type="float", default=.5,
+            help="Cutoff for collapsing low supported nodes "
+            "[default: %default]")
+    p.add_option("--phylipconsense", action="store_true", default=False,
+            help="True if input trees are generated in Phylip CONSENSE "
+            "[default: %default]")
+    options, args = p.parse_args(args)
+
+    if not args:
+        sys.exit(not p.print_help())
+
+    for spec in args:
+        name, _, treefile = spec.rpartition("=")
+        name = name or op.basename(treefile).rsplit(".", 1)[0]
+        if not op.exists(treefile):
+            p.error("File %s not found" % treefile)
+        load_tree(name, treefile, treeformat=options.treeformat,
+                  support_cutoff=options.support_cutoff,
+                  phylipconsense=options.phylipconsense)
+        index = _trees[name][0]
+        print >>sys.stderr, "tree %s loaded (%d leaves)" % (name,
+                                                            index.nleaves)
+
+    service = Service(workers=options.workers, timeout=options.timeout)
+    server = make_server(service, socket=options.socket, host=options.host,
+                         port=options.port)
+    print >>sys.stderr, "listening on %s" % (options.socket or \
+                                    "http://%s:%d" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if options.socket and op.exists(options.socket):
+            os.remove(options.socket)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Node table of a run: one row per internal node below the root, in preorder,
+with its parent, its leaf interval [leaf_start, leaf_end), the group sizes,
+the note (member mean or category), and the P-value with its minima. The
+nodes are numbered as in --printall, from 0, and parent_id -1 is the root.
+
+The table is written either as a TSV stream, generated in chunks of rows with
+the values at full precision, or as a columnar .npz file. The .npz members
+are stored uncompressed, so load_node_table() memory-maps the columns instead
+of reading them, and a million-node table is filtered without parsing text.
+"""
+
+import struct
+import zipfile
+
+import numpy as np
+
+
+NODE_FIELDS = ("node_id", "parent_id", "leaf_start", "leaf_end", "ntaxa_a",
+               "ntaxa_b", "note", "pvalue", "min_ancestor_pvalue",
+               "min_descendant_pvalue")
+PERMUTATION_FIELDS = ("empirical", "fdr")
+
+
+def node_columns(scan, na, nb, notes, val, hi_min, lo_min, empirical=None,
+                 fdr=None):
+    """ Columns of the node table, from the TraitScan of the tree and the
+    per-node arrays (the root first, it is left out of the table). `notes`
+    is a list of strings.
+    """
+    columns = dict(node_id=np.arange(len(scan) - 1),
+                   parent_id=scan.parent[1:] - 1,
+                   leaf_start=scan.starts[1:], leaf_end=scan.ends[1:],
+                   ntaxa_a=np.asarray(na[1:], dtype=np.int64),
+                   ntaxa_b=np.asarray(nb[1:], dtype=np.int64),
+                   note=notes[1:], pvalue=val[1:],
+                   min_ancestor_pvalue=hi_min[1:],
+                   min_descendant_pvalue=lo_min[1:])
+    if empirical is not None:
+        columns.update(empirical=empirical[1:], fdr=fdr[1:])
+    return columns
+
+
+def table_fields(columns):
+    return NODE_FIELDS + (PERMUTATION_FIELDS if "fdr" in columns else ())
+
+
+def iter_node_table(columns, chunksize=1 << 16):
+    """ Lines of the TSV table, the header first. The floats are written
+    with repr(), which reads back to the same values.
+    """
+    fields = table_fields(columns)
+    yield "\t".join(fields) + "\n"
+    fmt = "\t".join(["%d"] * 6 + ["%s"] + ["%r"] * (len(fields) - 7)) + "\n"
+    m = len(columns["node_id"])
+    for lo in xrange(0, m, chunksize):
+        hi = min(lo + chunksize, m)
+        chunk = [columns[x][lo:hi] for x in fields]
+        chunk = [x.tolist() if isinstance(x, np.ndarray) else x for x in chunk]
+        for row in zip(*chunk):
+            yield fmt % row
+
+
+def write_node_table(filehandle, columns):
+    for line in iter_node_table(columns):
+        filehandle.write(line)
+
+
+def save_node_table(filename, columns):
+    """ Columnar node table, one uncompressed .npy member per field.
+    """
+    arrays = {}
+    for x in table_fields(columns):
+        if x == "note":
+            arrays[x] = np.array(list(columns[x]), dtype="S")
+        else:
+            arrays[x] = np.ascontiguousarray(columns[x])
+    np.savez(filename, **arrays)
+
+
+def dump_node_table(filename, columns):
+    """ Columnar when `filename` ends with .npz, TSV otherwise.
+    """
+    if filename.endswith(".npz"):
+        save_node_table(filename, columns)
+    else:
+        with open(filename, "w") as fw:
+            write_node_table(fw, columns)
+
+
+def load_node_table(filename, mmap_mode="r"):
+    """ Columns of a table from save_node_table, memory-mapped from the .npz
+    file at the offsets of its members.
+    """
+    from numpy.lib import format as npformat
+
+    columns = {}
+    with open(filename, "rb") as fp:
+        for info in zipfile.ZipFile(fp).infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("%s is compressed" % filename)
+            # local file header, then the name and the extra field
+            fp.seek(info.header_offset + 26)
+            nlen, xlen = struct.unpack("<HH", fp.read(4))
+            fp.seek(info.header_offset + 30 + nlen + xlen)
+            version = npformat.read_magic(fp)
+            if version == (1, 0):
+                shape, fortran, dtype = npformat.read_array_header_1_0(fp)
+            else:
+                shape, fortran, dtype = npformat.read_array_header_2_0(fp)
+            name = info.filename[:-len(".npy")]
+            if not np.prod(shape):
+                columns[name] = np.empty(shape, dtype=dtype)
+                continue
+            columns[name] = np.memmap(fp.name, dtype=dtype, mode=mmap_mode,
+                                      shape=shape, offset=fp.tell(),
+                                      order="F" if fortran else "C")
+    return columns
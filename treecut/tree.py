@@ -4,104 +4,535 @@
 """
 ExtTree class is similar to the ete2.Tree, but each node has an associated P-value
 this allows easy propagation of P-values either ascending or descending the tree.
+
+The topology is read from a TreeIndex, so the in-group and out-group of every
+node are leaf intervals instead of materialized leaf sets. The P-values and
+their minima are kept in arrays shared by all the nodes (NodeArrays), so that
+the propagation and the updates of update_values() are vectorized.
 """
 
 import sys
-from stats import stat_test, mean
+import numpy as np
+from itertools import islice
+
+import profiling
+from stats import category_matrix, continuous_pvalues, continuous_sums, \
+            test_continuous_all, test_discrete_all
+from batch import TraitScan
+from index import TreeIndex
+from modules import ModulePath
+from parallel import test_nodes_parallel
+from permute import permutation_test
+from table import node_columns
+
+
+def leaf_data(leaves, values, datatype):
+    """ The values of the leaves in leaf order (NaN when missing), or for
+    discrete values the leaf x category matrix and the category names.
+    """
+    if datatype == "continuous":
+        return np.array([values.get(acc, np.nan) for acc in leaves]), None
+    return category_matrix([values.get(acc) for acc in leaves])
+
+
+class NodeArrays(object):
+    """
+    P-value, hi_min and lo_min of all the internal nodes, in preorder (the
+    position of a node is its `pos`), with the node objects and the depth
+    levels of the tree for the sweeps.
+    """
+
+    def __init__(self, index, scan=None):
+        self.scan = scan or TraitScan(index)
+        m = len(self.scan)
+        self.val = np.ones(m)
+        # continuous test, one of stats.CONTINUOUS_TESTS
+        self.test = "ttest"
+        self.hi_min = np.ones(m)
+        self.lo_min = np.ones(m)
+        self.nodes = []
+        # continuous sufficient statistics, for update_values()
+        self.sums = None
+        self.leaf_order = None
+        self.internal = None
+        self.permuted = False
+        # ModulePath of val, hi_min and lo_min, until they change
+        self.modpath = None
+        # leaf_data() of the values, when given by the caller
+        self.data = None
+        # tested mask before the pending edits, or True (discrete)
+        self.stale = False
+        self.touched = []
+
+    def path(self, leaf):
+        """ Positions of the internal nodes above a leaf (in leaf order).
+        """
+        index = self.scan.index
+        parent = index.parent
+        v = parent[index.leaf_nodes[leaf]]
+        ids = []
+        while v >= 0:
+            ids.append(v)
+            v = parent[v]
+        if self.internal is None:
+            self.internal = index.internal_nodes
+        return np.searchsorted(self.internal, ids)
 
 
 class ExtTree(list):
-    __slots__ = ("node", "values", "values2", "datatype", "a", "b", "val",
-            "hi_min", "lo_min", "note", "desc")
+    __slots__ = ("index", "id", "pos", "arrays", "values", "values2",
+            "datatype", "valued", "note", "desc", "empirical", "fdr")
+
+    def __init__(self, index, values, values2, datatype="continuous",
+                 prune=None, jobs=1, results=None, scan=None, leaf_data=None,
+                 test="ttest"):
+
+        # the accessions were once the fourth argument
+        if datatype not in ("continuous", "discrete"):
+            raise ValueError("datatype must be 'continuous' or 'discrete', "
+                             "not %r (ExtTree no longer takes the accessions)"
+                             % (datatype,))
+        if not isinstance(index, TreeIndex):
+            index = TreeIndex.from_ete(index)
+
+        # cumulative number of leaves that have values, in leaf order
+        valued = np.zeros(index.nleaves + 1, dtype=np.int64)
+        np.cumsum([x in values for x in index.leaves], out=valued[1:])
 
-    def __init__(self, node, values, values2, accs, datatype="continuous"):
+        # one object per internal node, built in preorder so that the parents
+        # are always there before their children
+        # `scan` is the TraitScan of an earlier tree on the same index
+        arrays = NodeArrays(index, scan=scan)
+        arrays.data = leaf_data
+        arrays.test = test
+        self.init_node(index, 0, arrays, values, values2, datatype, valued)
+        nodes = {0: self}
+        parent = index.parent
+        for n in index.internal_nodes.tolist():
+            if n == 0:
+                continue
+            e = nodes[n] = ExtTree.__new__(ExtTree)
+            e.init_node(index, n, arrays, values, values2, datatype, valued)
+            nodes[parent[n]].append(e)
 
-        self.node = node
+        if results is not None:
+            # from results() of an earlier run on the same tree and values
+            arrays.val[:] = results["val"]
+            for e, note in zip(arrays.nodes, results["note"]):
+                e.note = note
+            if "hi_min" in results:
+                arrays.hi_min[:] = results["hi_min"]
+                arrays.lo_min[:] = results["lo_min"]
+                return
+            # or only the P-values and notes, where NaN are still to test
+            missing = np.isnan(arrays.val)
+            if missing.any():
+                self.test_nodes(prune=prune, jobs=jobs, only=missing)
+        else:
+            self.test_nodes(prune=prune, jobs=jobs)
+        # core dynamic programming
+        self.lomin()
+        self.himin()
+
+    def init_node(self, index, id, arrays, values, values2, datatype, valued):
+        self.index = index
+        self.id = id
+        self.pos = len(arrays.nodes)
+        self.arrays = arrays
+        arrays.nodes.append(self)
         self.values = values
         self.values2 = values2
         self.datatype = datatype
+        self.valued = valued
         self.note = ""
         self.desc = ""
+        self.empirical = self.fdr = None
+
+    def __str__(self):
+        return "%d\t%d\t%s\t%.1g\t%.1g\t%.1g" % (\
+                self.na, self.nb, self.note,
+                self.val, self.hi_min, self.lo_min)
+
+    @property
+    def val(self):
+        return self.arrays.val[self.pos]
+
+    @val.setter
+    def val(self, x):
+        self.arrays.val[self.pos] = x
+        self.arrays.modpath = None
+
+    @property
+    def hi_min(self):
+        return self.arrays.hi_min[self.pos]
+
+    @hi_min.setter
+    def hi_min(self, x):
+        self.arrays.hi_min[self.pos] = x
+        self.arrays.modpath = None
+
+    @property
+    def lo_min(self):
+        return self.arrays.lo_min[self.pos]
+
+    @lo_min.setter
+    def lo_min(self, x):
+        self.arrays.lo_min[self.pos] = x
+        self.arrays.modpath = None
+
+    @property
+    def name(self):
+        return self.index.names[self.id]
+
+    @property
+    def dist(self):
+        return self.index.dist[self.id]
 
-        for n in node.children:
-            if not n.is_leaf():
-                self.append(ExtTree(n, values, values2, accs, datatype=datatype))
+    @property
+    def support(self):
+        return self.index.support[self.id]
 
-        nset = set(x.name for x in node.iter_leaves())
-        oset = accs - nset
+    @property
+    def na(self):
+        valued = self.valued
+        return valued[self.index.end[self.id]] - valued[self.index.start[self.id]]
 
+    @property
+    def nb(self):
+        return self.valued[-1] - self.na
+
+    @property
+    def a(self):
         # values for the direct children
-        self.a = a = self.get_values(nset, values)
+        leaves = self.index.leaves
+        s, e = self.index.start[self.id], self.index.end[self.id]
+        return self.get_values(leaves[s:e], self.values)
+
+    @property
+    def b(self):
         # values for non-children (sibs)
-        self.b = b = self.get_values(oset, values)
+        leaves = self.index.leaves
+        s, e = self.index.start[self.id], self.index.end[self.id]
+        return self.get_values(leaves[:s] + leaves[e:], self.values)
 
-        self.val = self.hi_min = self.lo_min = 1.0
+    def test_nodes(self, prune=None, jobs=1, only=None):
+        """ Run the statistical test for all the nodes, this must be the root.
 
-        if a and b:
-            sys.stderr.write(".")
-            self.val, self.note = stat_test(a, b, datatype=datatype)
+        For discrete data, `prune` is the P-value cutoff below which the modules
+        are sought; the nodes that cannot reach it are skipped, and only get a
+        lower bound of their P-value. When `jobs` is above 1, the tests run on
+        a pool of processes. `only` is a mask of the nodes to test, the others
+        keep their P-values and notes.
+        """
+        arrays = self.arrays
+        scan = arrays.scan
+        if only is None:
+            only = np.ones(len(scan), dtype=bool)
+        na = self.valued[scan.ends] - self.valued[scan.starts]
+        tested = np.flatnonzero((na > 0) & (self.valued[-1] - na > 0) & only)
+        starts, ends = scan.starts[tested], scan.ends[tested]
+        data, categories = self.leaf_data()
+        profiling.count("nodes_tested", len(tested))
 
-        # core dynamic programming
+        if jobs > 1:
+            p_values, results = test_nodes_parallel(data, starts, ends, jobs,
+                                                    cutoff=prune,
+                                                    test=arrays.test)
+        elif self.datatype == "continuous" and arrays.test == "ranksum":
+            arrays.sums = None
+            p_values, results = test_continuous_all(data, starts, ends,
+                                                    test="ranksum")
+        elif self.datatype == "continuous":
+            # sums over all the nodes, kept for update_values()
+            mu, sums, totals = arrays.sums = \
+                    continuous_sums(data, scan.starts, scan.ends)
+            p_values, ma = continuous_pvalues(*(sums + totals),
+                                              test=arrays.test)
+            p_values, results = p_values[tested], ma[tested] + mu
+        else:
+            p_values, results = test_discrete_all(data, starts, ends,
+                                                  cutoff=prune)
+
+        if self.datatype == "continuous":
+            notes = ["%.2g" % m for m in results]
+        else:
+            notes = [categories[x] if x >= 0 else "" for x in results]
+
+        arrays.val[only] = 1
+        for i in np.flatnonzero(only).tolist():
+            arrays.nodes[i].note = ""
+        arrays.val[tested] = p_values
+        for i, note in zip(tested.tolist(), notes):
+            arrays.nodes[i].note = note
+
+    def update_values(self, changes, refresh=True):
+        """
+        Change the values of some accessions, {acc: value} where a value of
+        None removes it, and refresh the P-values, hi_min and lo_min (and so
+        the modules). The values dict given to ExtTree is updated in place.
+
+        For continuous values, the count, sum and sum of squares only change
+        on the root paths of the changed leaves. The out-group of every node
+        changes with the totals, so refresh() then recomputes all the
+        P-values from the kept sums, in one vectorized pass; pass
+        refresh=False to apply several edits before a single refresh().
+        Discrete values, and the rank-sum test where a value changes the
+        ranks of the others, re-run every node test, which costs as much as
+        testing a new tree. An accession that is not a leaf of the tree
+        raises ValueError, before any value is changed.
+        """
+        arrays, values, valued = self.arrays, self.values, self.valued
+        if arrays.leaf_order is None:
+            arrays.leaf_order = dict((x, i) for i, x in \
+                                     enumerate(self.index.leaves))
+        unknown = [acc for acc in changes if acc not in arrays.leaf_order]
+        if unknown:
+            raise ValueError("accessions not in the tree: %s" %
+                             ", ".join(sorted(map(str, unknown))))
+        arrays.data = None
+        if arrays.permuted:
+            for e in arrays.nodes:
+                e.empirical = e.fdr = None
+            arrays.permuted = False
+
+        if self.datatype != "continuous":
+            for acc, value in changes.items():
+                leaf = arrays.leaf_order[acc]
+                dc = (value is not None) - (acc in values)
+                if dc:
+                    valued[leaf + 1:] += dc
+                if value is None:
+                    values.pop(acc, None)
+                else:
+                    values[acc] = value
+            arrays.stale = True
+            if refresh:
+                self.refresh()
+            return
+
+        mu, (cnt, s, ss), (n, total, sstotal) = self.get_sums()
+        if arrays.stale is False:
+            arrays.stale = (cnt > 0) & (n - cnt > 0)
+
+        for acc, value in changes.items():
+            leaf = arrays.leaf_order[acc]
+            if value is not None and np.isnan(value):
+                value = None
+            dc = ds = dss = 0
+            old = values.get(acc)
+            if old is not None:
+                dc, ds, dss = -1, -(old - mu), -(old - mu) ** 2
+                del values[acc]
+            if value is not None:
+                dc, ds, dss = dc + 1, ds + (value - mu), dss + (value - mu) ** 2
+                values[acc] = value
+
+            path = arrays.path(leaf)
+            cnt[path] += dc
+            s[path] += ds
+            ss[path] += dss
+            n, total, sstotal = n + dc, total + ds, sstotal + dss
+            if dc:
+                valued[leaf + 1:] += dc
+            arrays.touched.extend(path.tolist())
+        arrays.sums = mu, (cnt, s, ss), (n, total, sstotal)
+        if refresh:
+            self.refresh()
+
+    def refresh(self):
+        """ Recompute the P-values, hi_min and lo_min after update_values().
+        """
+        arrays = self.arrays
+        if arrays.stale is False:
+            return
+        if self.datatype != "continuous" or arrays.test == "ranksum":
+            self.test_nodes()
+        else:
+            mu, (cnt, s, ss), (n, total, sstotal) = self.get_sums()
+            p_values, ma = continuous_pvalues(cnt, s, ss, n, total, sstotal,
+                                              test=arrays.test)
+            tested = (cnt > 0) & (n - cnt > 0)
+            p_values[~tested] = 1
+            arrays.val[:] = p_values
+
+            # member means only change on the paths
+            changed = np.flatnonzero(tested != arrays.stale).tolist()
+            for i in set(changed).union(arrays.touched):
+                arrays.nodes[i].note = "%.2g" % (ma[i] + mu) \
+                                       if tested[i] else ""
+        arrays.stale = False
+        arrays.touched = []
         self.lomin()
         self.himin()
 
-    def __str__(self):
-        return "%d\t%d\t%s\t%.1g\t%.1g\t%.1g" % (\
-                len(self.a), len(self.b), self.note,
-                self.val, self.hi_min, self.lo_min)
+    def get_sums(self):
+        """ Center of the continuous values, and the count, sum and sum of
+        squares of the internal nodes and over all the leaves.
+        """
+        arrays = self.arrays
+        if arrays.sums is None:
+            data, categories = self.leaf_data()
+            arrays.sums = continuous_sums(data, arrays.scan.starts,
+                                          arrays.scan.ends)
+        return arrays.sums
+
+    def results(self):
+        """ P-values, notes, hi_min and lo_min of the internal nodes, in
+        preorder. They can be passed back to ExtTree to skip the tests.
+        """
+        arrays = self.arrays
+        return {"val": arrays.val.copy(),
+                "note": [e.note for e in arrays.nodes],
+                "hi_min": arrays.hi_min.copy(),
+                "lo_min": arrays.lo_min.copy()}
+
+    def intervals(self, nodes):
+        ids = np.array([e.id for e in nodes], dtype=np.int64)
+        return self.index.start[ids], self.index.end[ids]
+
+    def leaf_data(self):
+        """ The leaf values in leaf order (NaN when missing), or for discrete
+        values the leaf x category matrix and the category names.
+        """
+        if self.arrays.data is not None:
+            return self.arrays.data
+        return leaf_data(self.index.leaves, self.values, self.datatype)
 
-    def __getattr__(self, attr):
-        if attr not in self.__slots__:
-            return getattr(self.node, attr)
+    def permutation_test(self, permutations=1000, seed=None):
+        """ Shuffle the values among the leaves to get the empirical P-value
+        and the node-level FDR of all the nodes below.
+        """
+        nodes = [e for e in self.get_all_nodes() if e.na and e.nb]
+        if not nodes:
+            return
+        starts, ends = self.intervals(nodes)
+        data, categories = self.leaf_data()
+        empirical, fdr = permutation_test(data, starts, ends,
+                                [e.val for e in nodes],
+                                permutations=permutations, seed=seed,
+                                test=self.arrays.test)
+        for e, p_value, q_value in zip(nodes, empirical, fdr):
+            e.empirical, e.fdr = p_value, q_value
+        self.arrays.permuted = True
 
-    def render(self, image_name, cutoff=.05, **kwargs):
+    def render(self, image_name, cutoff=.05, lod=0, **kwargs):
         from draw import Dendrogram
-        d = Dendrogram(self, datatype=self.datatype, cutoff=cutoff)
+        d = Dendrogram(self, datatype=self.datatype, cutoff=cutoff, lod=lod,
+                       dpi=kwargs.get("dpi"))
         d.savefig(image_name, **kwargs)
         print >>sys.stderr, "tree image saved to %s" % image_name
 
     def get_values(self, leaf_set, values):
         return [values[x] for x in leaf_set if x in values]
 
+    def get_leaf_names(self):
+        return self.index.get_leaf_names(self.id)
+
     def get_all_nodes(self):
+        """ All the nodes below, in preorder.
+        """
+        if self.pos == 0:
+            return self.arrays.nodes[1:]
         res = []
-        for e in self:
+        stack = self[::-1]
+        while stack:
+            e = stack.pop()
             res.append(e)
-            res += e.get_all_nodes()
+            stack.extend(reversed(e))
         return res
 
+    def module_path(self):
+        """ ModulePath of the tree, to get the modules at any cutoff.
+        """
+        arrays = self.arrays
+        if arrays.modpath is None:
+            arrays.modpath = ModulePath(arrays.val, arrays.hi_min,
+                                        arrays.lo_min)
+        return arrays.modpath
+
     def get_modules(self, cutoff=.05):
+        arrays = self.arrays
+        if self.datatype=="continuous":
+            # compare the group means from the sums, not the value lists
+            mu, (cnt, s, ss), (n, total, sstotal) = self.get_sums()
         modules = []
-        for e in self:
-            if e.val < min(e.lo_min, e.hi_min, cutoff):
-                if self.datatype=="continuous":
-                    e.desc = "lo" if mean(e.a) < mean(e.b) else "hi"
-                else:
-                    e.desc = "enriched"
-                modules.append(e)
+        for i in self.module_path().modules(cutoff).tolist():
+            e = arrays.nodes[i]
+            if self.pos and not self.id < e.id < self.id + self.index.size[self.id]:
+                continue
+            if self.datatype=="continuous":
+                lo = s[i] / cnt[i] < (total - s[i]) / (n - cnt[i])
+                e.desc = "lo" if lo else "hi"
             else:
-                modules += e.get_modules(cutoff=cutoff)
+                e.desc = "enriched"
+            modules.append(e)
         return modules
 
+    def node_table(self):
+        """ Columns of the node table (see treecut.table) of the whole tree.
+        """
+        arrays = self.arrays
+        scan = arrays.scan
+        na = self.valued[scan.ends] - self.valued[scan.starts]
+        empirical = fdr = None
+        if arrays.permuted:
+            empirical = np.array([np.nan if e.empirical is None else \
+                                  e.empirical for e in arrays.nodes])
+            fdr = np.array([np.nan if e.fdr is None else e.fdr \
+                            for e in arrays.nodes])
+        return node_columns(scan, na, self.valued[-1] - na,
+                            [e.note for e in arrays.nodes], arrays.val,
+                            arrays.hi_min, arrays.lo_min,
+                            empirical=empirical, fdr=fdr)
+
     verbose_fields = ("node_id ntaxa_a ntaxa_b member_mean P-value min_ancestor_P-value min_descendant_P-value").split()
 
+    cutoff_fields = ("cutoff nmodules node_id desc note leaves").split()
+
     def print_all_nodes(self, filehandle):
-        for i, e in enumerate(self.get_all_nodes()):
+        nodes = self.get_all_nodes() if self.pos else \
+                islice(self.arrays.nodes, 1, None)
+        for i, e in enumerate(nodes):
             print >>filehandle, "%d\t%s" % (i, e)
 
     def print_modules(self, filehandle, cutoff=.05):
         modules = self.get_modules(cutoff=cutoff)
         for i, e in enumerate(modules):
-            print >>filehandle, "%s\t%s\t%s\t%.1g" % (",".join(sorted(e.get_leaf_names())), e.desc, e.note, e.val)
+            line = "%s\t%s\t%s\t%.1g" % (",".join(sorted(e.get_leaf_names())), e.desc, e.note, e.val)
+            if e.empirical is not None:
+                line += "\t%.2g\t%.2g" % (e.empirical, e.fdr)
+            print >>filehandle, line
         return modules
 
+    def print_cutoff_table(self, filehandle):
+        """
+        The modules of every cutoff in one sweep: each candidate module by
+        increasing P-value, which is a module for all the cutoffs above that
+        P-value, with the number of modules from there on.
+        """
+        path = self.module_path()
+        modules = dict((e.pos, e) for e in self.get_modules(cutoff=np.inf))
+        table = path.table()
+        print >>filehandle, "\t".join(self.cutoff_fields)
+        for cutoff, nmodules, i in zip(table["cutoff"].tolist(),
+                                       table["nmodules"].tolist(),
+                                       table["node_id"].tolist()):
+            e = modules.get(i)
+            if e is None:
+                continue
+            print >>filehandle, "%.3g\t%d\t%d\t%s\t%s\t%s" % (cutoff,
+                    nmodules, i - 1, e.desc, e.note,
+                    ",".join(sorted(e.get_leaf_names())))
+
     def himin(self):
-        for e in self:
-            e.hi_min = min(self.val, self.hi_min)
-            e.himin()
+        # one sweep down the depth levels, parents before their children
+        arrays = self.arrays
+        arrays.hi_min[:] = arrays.scan.hi_minima(arrays.val)
+        arrays.modpath = None
 
     def lomin(self):
-        if len(self)!=0:
-            self.lo_min = min([x.lomin() for x in self] +\
-                    [x.val for x in self])
+        # one sweep up the depth levels, children before their parents
+        arrays = self.arrays
+        arrays.lo_min[:] = arrays.scan.lo_minima(arrays.val)
+        arrays.modpath = None
         return self.lo_min
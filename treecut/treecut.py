@@ -20,18 +20,31 @@ treefile is a Newick-formatted file, format code is according to ete2 package, a
 listfile contains the accession=>value mapping, separated by comma
 optional [imagefile] will generate an image (.svg, .png, .jpg, .pdf, etc. are supported)
 
+python %prog serve [options] name=treefile ... keeps the trees loaded and
+answers queries over HTTP or a Unix socket, see treecut/server.py
+
 Python script that traverses through a hierarchical clustering tree
 and calculate the significance values on all inner nodes and determine
 the nodes that gives the least P-value
 """
 
+import copy
 import os.path as op
 import sys
 import csv
-import ete2
+import re
+import numpy as np
 from optparse import OptionParser
 
-from .tree import ExtTree
+from . import profiling
+from .batch import TraitScan
+from .cache import CACHE_DIR, ResultCache
+from .index import TreeIndex
+from .newick import NewickError, iter_newick, read_newick
+from .profiling import Profiler, stage
+from .stats import CONTINUOUS_TESTS
+from .table import dump_node_table
+from .tree import ExtTree, leaf_data
 
 
 def read_values(listfile, datatype="continuous"):
@@ -51,47 +64,301 @@ def read_values(listfile, datatype="continuous"):
     return values
 
 
+def read_traits(listfile, datatype="continuous"):
+    """ Read all the value columns of listfile, one trait per column. Returns
+    the trait names, from the '#' header line if there is one, and the
+    accession=>values mapping, where the missing values are NaN (continuous)
+    or None (discrete).
+    """
+    reader = csv.reader(file(listfile))
+    traits, rows = None, {}
+    for rec in reader:
+        if len(rec) < 2: continue
+        acc, fields = rec[0], rec[1:]
+        if acc[0]=="#":
+            if traits is None and not rows:
+                traits = [x.strip() for x in fields]
+            continue
+        if datatype=="continuous":
+            row = []
+            for value in fields:
+                try:
+                    row.append(float(value))
+                except:
+                    row.append(np.nan)
+        else:
+            row = [value.split(";") if value else None for value in fields]
+        rows[acc] = row
+
+    ntraits = max([len(x) for x in rows.values()] + [len(traits or [])])
+    if traits is None:
+        traits = []
+    traits += ["trait%d" % (i + 1) for i in xrange(len(traits), ntraits)]
+    missing = np.nan if datatype=="continuous" else None
+    values = {}
+    for acc, row in rows.items():
+        values[acc] = row + [missing] * (ntraits - len(row))
+    return traits, values
+
+
+def read_tree(treefile, treeformat=0):
+    """ Parse the Newick file into a TreeIndex. Files that the native parser
+    rejects are given to ete2 instead, when it is installed.
+    """
+    try:
+        return read_newick(treefile, format=treeformat)
+    except NewickError as e:
+        try:
+            import ete2
+        except ImportError:
+            raise e
+        print >>sys.stderr, "[warning] %s, trying ete2" % e
+        return TreeIndex.from_ete(ete2.Tree(treefile, format=treeformat))
+
+
 def process_phylip_consense(tree):
     """ PHYLIP consense program generates tree that has branch length
     proportional to bootstrap support values. This function transforms the
     support values to node supports, and set all branch length to 1, which
-    should be ignored when drawing.
+    should be ignored when drawing. The tree is copied, not changed.
     This is specific for PHYLIP consense only.
     """
-    for node in tree.traverse("postorder"):
-        node.support = float(node.dist)/100.
-        node.dist = 1.0
+    tree = copy.copy(tree)
+    tree.support = tree.dist / 100.
+    tree.dist = np.ones(len(tree))
     return tree
 
 
-def collapse_nodes(tree, support_cutoff=0.5):
-    """Collapse low support nodes for better biological interpretation."""
-    for node in tree.traverse("postorder"):
-        if node.support < support_cutoff: node.delete()
-    return tree
+def collapse_nodes(tree, support_cutoff=0.5, phylipconsense=False):
+    """Collapse low support nodes for better biological interpretation.
+
+    Nodes are deleted in postorder as in ete2, where the children of a deleted
+    node are appended to its parent, and a parent that is left with a single
+    child is deleted as well. The root is never deleted. With phylipconsense,
+    the supports are first taken from the branch lengths.
+
+    This is done in one pass: the child lists are linked lists, so a deleted
+    node hands its whole list to its parent at once, and the children keep
+    pointing to the deleted node, which resolves to its parent (as in
+    union-find). The collapsed tree is then read out in preorder.
+    """
+    if phylipconsense:
+        tree = process_phylip_consense(tree)
+    n = len(tree)
+    low = tree.support < support_cutoff
+    low[0] = False
+    if not low.any():
+        return tree
+
+    # first and last child, and the siblings, in the order of the children
+    ptr, idx = tree.child_ptr, tree.child_idx
+    nchildren = np.diff(ptr)
+    has = np.flatnonzero(nchildren)
+    first = np.full(n, -1, dtype=np.int64)
+    last = np.full(n, -1, dtype=np.int64)
+    first[has], last[has] = idx[ptr[has]], idx[ptr[has + 1] - 1]
+    nxt = np.full(n, -1, dtype=np.int64)
+    prv = np.full(n, -1, dtype=np.int64)
+    same = tree.parent[idx[:-1]] == tree.parent[idx[1:]]
+    nxt[idx[:-1][same]] = idx[1:][same]
+    prv[idx[1:][same]] = idx[:-1][same]
+
+    first, last, nxt, prv = first.tolist(), last.tolist(), nxt.tolist(), \
+                            prv.tolist()
+    count = nchildren.tolist()
+    up = tree.parent.tolist()
+    gone = [False] * n
+
+    def find(x):
+        # the nearest node above that is still in the tree
+        r = x
+        while r >= 0 and gone[r]:
+            r = up[r]
+        while x != r:
+            up[x], x = r, up[x]
+        return r
+
+    def delete(v, cascade=True):
+        p = find(up[v])
+        if p < 0:
+            return
+        if count[v]:
+            f = first[v]
+            if last[p] >= 0:
+                nxt[last[p]], prv[f] = f, last[p]
+            else:
+                first[p] = f
+            last[p] = last[v]
+            count[p] += count[v]
+        a, b = prv[v], nxt[v]
+        if a >= 0:
+            nxt[a] = b
+        else:
+            first[p] = b
+        if b >= 0:
+            prv[b] = a
+        else:
+            last[p] = a
+        count[p] -= 1
+        gone[v], up[v] = True, p
+        if cascade and count[p] < 2:
+            delete(p, cascade=False)
+
+    # postorder of the original tree: the later changes to a child list only
+    # append the children of its deleted descendants
+    plist, ilist = ptr.tolist(), idx.tolist()
+    low = low.tolist()
+    stack = [0]
+    while stack:
+        v = stack.pop()
+        if v >= 0 and plist[v] < plist[v + 1]:
+            stack.append(~v)
+            stack.extend(reversed(ilist[plist[v]:plist[v + 1]]))
+            continue
+        v = ~v if v < 0 else v
+        if low[v] and not gone[v]:
+            delete(v)
+
+    order, parent = [], []
+    stack = [(0, -1)]
+    while stack:
+        v, p = stack.pop()
+        parent.append(p)
+        p = len(order)
+        order.append(v)
+        c = last[v]
+        while c >= 0:
+            stack.append((c, p))
+            c = prv[c]
+
+    names = tree.names
+    collapsed = TreeIndex(parent, [names[v] for v in order],
+                          dist=tree.dist[order], support=tree.support[order])
+    collapsed.origin = np.array(order, dtype=np.int64)
+    return collapsed
+
+
+def sweep_support(tree, values, support_cutoffs, datatype="continuous",
+                  prune=None, jobs=1, test="ttest"):
+    """
+    Collapse the parsed tree at each of the support cutoffs (in increasing
+    order), and yield the cutoff and its ExtTree. The leaf data is built once,
+    and a clade that survives from one cutoff to the next keeps its P-value
+    and note, so only the clades that are new get tested; all of them are
+    tested again if the collapsing removed leaves.
+    """
+    data, categories = leaf_data(tree.leaves, values, datatype)
+    leaf_order = dict((x, i) for i, x in enumerate(tree.leaves))
+
+    last = None
+    for support_cutoff in sorted(support_cutoffs):
+        index = collapse_nodes(tree, support_cutoff=support_cutoff)
+        origin = index.origin if index.origin is not None else \
+                 np.arange(len(index))
+        ids = origin[index.internal_nodes]
+        rows = np.array([leaf_order[x] for x in index.leaves], dtype=np.int64)
+
+        results = None
+        if last is not None and last[0] == index.nleaves:
+            nleaves, last_ids, last_val, last_notes = last
+            order = np.argsort(last_ids)
+            k = np.searchsorted(last_ids[order], ids)
+            k = order[k.clip(0, len(order) - 1)]
+            found = last_ids[k] == ids
+            val = np.where(found, last_val[k], np.nan)
+            notes = [last_notes[i] if f else "" for i, f in \
+                     zip(k.tolist(), found.tolist())]
+            results = dict(val=val, note=notes)
+
+        t = ExtTree(index, values, None, datatype=datatype, prune=prune,
+                    jobs=jobs, results=results,
+                    leaf_data=(data[rows], categories), test=test)
+        last = index.nleaves, ids, t.arrays.val.copy(), \
+               [e.note for e in t.arrays.nodes]
+        yield support_cutoff, t
 
 
 def main(args):
     """ Main entry point of treecut
     """
+    if args and args[0] == "serve":
+        from .server import main as serve
+        return serve(args[1:])
+
     p = OptionParser(__doc__)
     p.add_option("--discrete", default=False, action="store_true",
             help="Are the data in listfile discrete? "
             "(use Fisher's exact test to calculate P-values) "
             "[default: %default (use t-test)]")
+    p.add_option("--test", choices=CONTINUOUS_TESTS, default="ttest",
+            help="Test of the continuous values: Student's t-test, Welch's "
+            "t-test (unequal variances) or the Mann-Whitney rank-sum test, "
+            "one of %s [default: %%default]" % "|".join(CONTINUOUS_TESTS))
     p.add_option("--cutoff", type="float", default=.01,
             help="Minimum P-value to report [default: %default]")
     p.add_option("--treeformat", type="int", default=0,
             help="Format for Newick input tree, see --help for details "
             "[default: %default]")
-    p.add_option("--support_cutoff", type="float", default=.5,
+    p.add_option("--support_cutoff", default="0.5",
             help="Cutoff for collapsing low supported nodes. "
-            "Use 0 for no nodes collapsing [default: %default]")
+            "Use 0 for no nodes collapsing, or a comma-separated list of "
+            "cutoffs to parse once and write one .clusters file per cutoff "
+            "[default: %default]")
     p.add_option("--phylipconsense", action="store_true", default=False,
             help="True if input tree is generated in Phylip CONSENSE "
             "[default: %default]")
+    p.add_option("--prune", action="store_true", default=False,
+            help="Skip the discrete tests that cannot reach --cutoff, the "
+            "P-values of skipped nodes are lower bounds [default: %default]")
+    p.add_option("--jobs", type="int", default=1,
+            help="Number of processes for the node tests [default: %default]")
     p.add_option("--printall", action="store_true", default=False,
             help="Print verbose information for all inner nodes [default: %default]")
+    p.add_option("--node_table",
+            help="Write all the inner nodes with their parents, leaf "
+            "intervals and full-precision P-values to this file, as columns "
+            "of an .npz file if it ends with .npz, or else as TSV")
+    p.add_option("--cutoff_table",
+            help="Write the modules of every P-value cutoff to this file, "
+            "each module with the cutoff above which it is reported")
+    p.add_option("--bootstrap",
+            help="Multi-tree Newick file of replicate trees (as given to "
+            "Phylip CONSENSE); the modules are written to the .stability "
+            "file with the fractions of the trees where their leaf set is a "
+            "clade and a module")
+    p.add_option("--noimage", action="store_true", default=False,
+            help="Only write the .clusters file, skip the tree image "
+            "[default: %default]")
+    p.add_option("--lod", type="float", default=0,
+            help="Draw the subtrees narrower than this many pixels outside "
+            "the modules as wedges, and the values as an image, for large "
+            "trees [default: %default (draw every leaf)]")
+    p.add_option("--batch", action="store_true", default=False,
+            help="Test every value column of listfile as a separate trait, "
+            "the results of each trait follow a '#trait' line in the "
+            ".clusters file [default: %default]")
+    p.add_option("--split_traits", action="store_true", default=False,
+            help="With --batch, write one .clusters file per trait "
+            "[default: %default]")
+    p.add_option("--permutations", type="int", default=0,
+            help="Number of leaf value shuffles, to add the empirical "
+            "P-value and the node-level FDR of the modules [default: %default]")
+    p.add_option("--seed", type="int", default=None,
+            help="Random seed for --permutations [default: %default]")
+    p.add_option("--cache", action="store_true", default=False,
+            help="Keep the node tests of this tree and listfile on disk, and "
+            "reuse them in later runs [default: %default]")
+    p.add_option("--cache_dir", default=CACHE_DIR,
+            help="Directory for --cache [default: %default]")
+    p.add_option("--cache_size", type="float", default=256,
+            help="Size cap of --cache_dir in MB, the least recently used "
+            "results are removed above it [default: %default]")
+    p.add_option("--profile",
+            help="Write the wall time, peak RSS and counts (nodes and "
+            "categories tested, cache hits) of every stage to this JSON file")
+    p.add_option("--progress", action="store_true", default=False,
+            help="Report the progress of the node tests and permutations "
+            "on stderr [default: %default]")
     options, args = p.parse_args(args)
 
     if len(args) == 2:
@@ -102,29 +369,91 @@ def main(args):
     else:
         sys.exit(not p.print_help())
 
+    for f in (treefile, listfile):
+        if not op.exists(f):
+            p.error("File %s not found" % f)
+
+    if options.batch and options.permutations:
+        p.error("--permutations is not supported with --batch")
+    if options.batch and options.cutoff_table:
+        p.error("--cutoff_table is not supported with --batch")
+    if options.bootstrap and not op.exists(options.bootstrap):
+        p.error("File %s not found" % options.bootstrap)
+
+    try:
+        options.support_cutoffs = [float(x) for x in \
+                                   options.support_cutoff.split(",")]
+    except ValueError:
+        p.error("--support_cutoff takes numbers separated by commas")
+    options.support_cutoff = options.support_cutoffs[0]
+    if options.batch and len(options.support_cutoffs) > 1:
+        p.error("A list of --support_cutoff is not supported with --batch")
+    if options.bootstrap and (options.batch or \
+                              len(options.support_cutoffs) > 1):
+        p.error("--bootstrap is not supported with --batch or a list of "
+                "--support_cutoff")
+
+    profiler = Profiler() if options.profile else None
+    profiling.start(profiler, progress=options.progress)
+    try:
+        run(options, treefile, listfile, outfile)
+    finally:
+        profiling.stop()
+    if profiler:
+        profiler.write(options.profile)
+        print >>sys.stderr, "profile saved to %s" % options.profile
+
+
+def run(options, treefile, listfile, outfile):
+    """ Run treecut with the options of main(), every step in its own
+    profiling stage.
+    """
     treeformat = options.treeformat
     phylipconsense = options.phylipconsense
     support_cutoff = options.support_cutoff
+    sweep = len(options.support_cutoffs) > 1
     datatype = "discrete" if options.discrete else "continuous"
 
-    for f in (treefile, listfile):
-        if not op.exists(f):
-            p.error("File %s not found" % f)
+    prune = options.cutoff if options.prune else None
+    cached = cache = None
+    if options.cache and not options.batch and not sweep:
+        cache = ResultCache(options.cache_dir,
+                            maxsize=int(options.cache_size * (1 << 20)))
+        key = cache.key(treefile, listfile, datatype=datatype,
+                        treeformat=treeformat, support_cutoff=support_cutoff,
+                        phylipconsense=phylipconsense, prune=prune,
+                        test=options.test)
+        with stage("cache"):
+            cached = cache.get(key)
+        profiling.count("cache_hits", cached is not None)
 
-    # the tree topology, format 5: internal and leaf branches + leaf names
-    tree = ete2.Tree(treefile, format=treeformat)
-
-    if phylipconsense:
-        tree = process_phylip_consense(tree)
+    if cached:
+        tree, results = cached
+    else:
+        # the tree topology, as a flat leaf-interval index shared by the
+        # tests and the rendering
+        with stage("parse"):
+            tree = read_tree(treefile, treeformat=treeformat)
 
-    # collapse low support nodes
-    tree = collapse_nodes(tree, support_cutoff=support_cutoff)
+        # collapse low support nodes, each cutoff of a sweep on its own
+        if sweep:
+            if phylipconsense:
+                tree = process_phylip_consense(tree)
+        else:
+            with stage("collapse"):
+                tree = collapse_nodes(tree, support_cutoff=support_cutoff,
+                                      phylipconsense=phylipconsense)
+        results = None
 
     # value mappings
-    values = read_values(listfile, datatype=datatype)
+    with stage("read_values"):
+        if options.batch:
+            traits, values = read_traits(listfile, datatype=datatype)
+        else:
+            values = read_values(listfile, datatype=datatype)
     values2 = None
 
-    tree_accs = set(x.name for x in tree.iter_leaves())  # terminal nodes
+    tree_accs = set(tree.leaves)  # terminal nodes
     list_accs = set(values.keys())
 
     for x in tree_accs - list_accs:
@@ -138,17 +467,115 @@ def main(args):
         print >>sys.stderr, "[warning] number of accessions don't match between treefile(%d) and listfile(%d)" % (n, m)
 
     # generate output
-    fw = open(outfile.split(".")[0]+".clusters", "w")
-    t = ExtTree(tree, values, values2, tree_accs, datatype=datatype)
+    prefix = outfile.split(".")[0]
+    if options.batch:
+        scan = TraitScan(tree)
+        if options.printall:
+            print >>sys.stderr, "\t".join(ExtTree.verbose_fields)
+        fw = None if options.split_traits else open(prefix+".clusters", "w")
+        # the tests of a block of traits run when its first trait is asked
+        with stage("batch"):
+            for r in scan.scan(traits, values, datatype=datatype,
+                               cutoff=options.cutoff, prune=prune,
+                               jobs=options.jobs, test=options.test):
+                if options.split_traits:
+                    name = re.sub(r"[^\w.-]+", "_", r.trait)
+                    fh = open("%s.%s.clusters" % (prefix, name), "w")
+                else:
+                    fh = fw
+                    print >>fh, "#%s" % r.trait
+                if options.printall:
+                    r.print_all_nodes(fh)
+                else:
+                    r.print_modules(fh)
+                if fh is not fw:
+                    fh.close()
+                if options.node_table:
+                    base, ext = op.splitext(options.node_table)
+                    name = re.sub(r"[^\w.-]+", "_", r.trait)
+                    dump_node_table("%s.%s%s" % (base, name, ext),
+                                    r.node_table())
+        if fw:
+            fw.close()
+        return
+
+    if sweep:
+        # "outfile" alone is drawn as outfile.png, as matplotlib does
+        image_ext = op.splitext(outfile)[1] or ".png"
+        with stage("sweep"):
+            for cutoff, t in sweep_support(tree, values,
+                    options.support_cutoffs, datatype=datatype, prune=prune,
+                    jobs=options.jobs, test=options.test):
+                name = "%s.support%g" % (prefix, cutoff)
+                if options.permutations:
+                    t.permutation_test(permutations=options.permutations,
+                                       seed=options.seed)
+                node_table = cutoff_table = None
+                if options.node_table:
+                    base, ext = op.splitext(options.node_table)
+                    node_table = "%s.support%g%s" % (base, cutoff, ext)
+                if options.cutoff_table:
+                    base, ext = op.splitext(options.cutoff_table)
+                    cutoff_table = "%s.support%g%s" % (base, cutoff, ext)
+                with open(name + ".clusters", "w") as fw:
+                    write_output(t, fw, options, node_table=node_table,
+                                 cutoff_table=cutoff_table)
+                if outfile and not options.noimage:
+                    t.render(name + image_ext, cutoff=options.cutoff,
+                             lod=options.lod, dpi=80)
+        return
+
+    fw = open(prefix+".clusters", "w")
+    with stage("tests"):
+        t = ExtTree(tree, values, values2, datatype=datatype, prune=prune,
+                    jobs=options.jobs, results=results, test=options.test)
+    if cache and not cached:
+        with stage("cache"):
+            cache.put(key, tree, t.results())
+    if options.permutations:
+        with stage("permutations"):
+            t.permutation_test(permutations=options.permutations,
+                               seed=options.seed)
+
+    with stage("output"):
+        write_output(t, fw, options)
+
+    if options.bootstrap:
+        from .bootstrap import module_stability, print_stability
+
+        with stage("bootstrap"):
+            trees = list(iter_newick(options.bootstrap,
+                                     format=treeformat))
+            stability = module_stability(t, trees, cutoff=options.cutoff,
+                                         support_cutoff=support_cutoff,
+                                         prune=prune, jobs=options.jobs)
+        with open(prefix + ".stability", "w") as fh:
+            print_stability(fh, *stability)
+        print >>sys.stderr, "module stability over %d trees saved to %s" % \
+                (stability[-1], prefix + ".stability")
 
+    if outfile and not options.noimage:
+        with stage("render"):
+            t.render(outfile, cutoff=options.cutoff, lod=options.lod, dpi=80)
+
+    fw.close()
+
+
+def write_output(t, fw, options, node_table=None, cutoff_table=None):
+    """ The modules (or all the nodes with --printall), the node table and
+    the cutoff table of the tree, into `node_table` and `cutoff_table` or
+    else --node_table and --cutoff_table.
+    """
     if options.printall:
         # header
         print >>sys.stderr, "\t".join(t.verbose_fields)
         t.print_all_nodes(fw)
     else:
         t.print_modules(fw, cutoff=options.cutoff)
-
-    if outfile:
-        t.render(outfile, cutoff=options.cutoff, dpi=80)
-
-    fw.close()
+    node_table = node_table or options.node_table
+    if node_table:
+        dump_node_table(node_table, t.node_table())
+    cutoff_table = cutoff_table or options.cutoff_table
+    if cutoff_table:
+        with open(cutoff_table, "w") as fh:
+            t.print_cutoff_table(fh)